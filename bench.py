@@ -0,0 +1,203 @@
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+import typing
+import wiki
+import wikitext
+
+# Namespace used for generated pages; the same template as the Main namespace
+SYNTHETIC_NS = {
+	"fields": {
+		"title": "text",
+		"content": "text"
+	},
+	"defaultPage": "Page_0",
+	"content": "$END<h5 style=\"margin: 0; padding: 0; color: gray; font-weight: normal;\">{{pagens}}:{{pagename}}</h5>\n<h1 style=\"margin-top: 0;\">{{field title $pagename}}</h1>\n$START{{field content There is currently no text in this page. Press the edit button on the left to add some.}}"
+}
+
+WORDS = ["wiki", "page", "history", "namespace", "field", "template", "revision", "link", "content", "title", "server", "cache", "index", "search", "render"]
+
+def generateContent(rng: random.Random, size: int, markup: float, pages: int) -> str:
+	# Roughly size characters of text; markup is the share of words that are
+	# bold, italic or a link to another generated page
+	lines: list[str] = []
+	line: list[str] = []
+	length = 0
+	while length < size:
+		word = rng.choice(WORDS)
+		if rng.random() < markup:
+			kind = rng.randrange(3)
+			if kind == 0: word = f"*{word}*"
+			elif kind == 1: word = f"_{word}_"
+			else: word = f"[[Page_{rng.randrange(max(1, pages))}]]"
+		line.append(word)
+		length += len(word) + 1
+		if len(line) >= 12:
+			lines.append(("# " if rng.random() < 0.05 else "") + " ".join(line))
+			line = []
+	lines.append(" ".join(line))
+	return "\n".join(lines)
+
+def generateWiki(directory: str, pages: int, revisions: int, fieldBytes: int, markup: float, seed: int = 1) -> list[str]:
+	# Makes directory/pages/ with a Main namespace of generated pages, each with
+	# the given number of revisions; returns the page names. Run with
+	# directory as the working directory.
+	rng = random.Random(seed)
+	os.makedirs(f"{directory}/pages/Main", exist_ok=True)
+	with open(f"{directory}/pages/Main/ns.json", "w") as f:
+		json.dump(SYNTHETIC_NS, f, indent="\t")
+	shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), "settings.json"), f"{directory}/settings.json")
+	cwd = os.getcwd()
+	os.chdir(directory)
+	try:
+		ns = wiki.Namespace.fromFile("Main")
+		assert ns != None
+		names: list[str] = []
+		for i in range(pages):
+			history = wiki.PageHistory(ns, f"Page_{i}", [])
+			history.append("Created", { "title": f"Page {i}".encode("UTF-8") })
+			for r in range(1, revisions):
+				history.appendEdit(f"Edit {r}", "content", generateContent(rng, fieldBytes, markup, pages).encode("UTF-8"))
+			history.save()
+			names.append(f"Main:Page_{i}")
+		return names
+	finally:
+		os.chdir(cwd)
+
+class Benchmark(typing.NamedTuple):
+	name: str
+	# Returns the function to time, set up for one run
+	setup: typing.Callable[[], typing.Callable[[], typing.Any]]
+
+def measure(benchmark: Benchmark, repeat: int, minTime: float) -> dict[str, typing.Any]:
+	func = benchmark.setup()
+	# Find how many calls take about minTime, so short functions are timed in batches
+	calls = 1
+	while True:
+		start = time.perf_counter()
+		for _ in range(calls): func()
+		elapsed = time.perf_counter() - start
+		if elapsed >= minTime or calls >= 1 << 20: break
+		calls *= 2
+	times: list[float] = []
+	for _ in range(repeat):
+		func = benchmark.setup()
+		start = time.perf_counter()
+		for _ in range(calls): func()
+		times.append((time.perf_counter() - start) / calls)
+	func = benchmark.setup()
+	tracemalloc.start()
+	func()
+	peak = tracemalloc.get_traced_memory()[1]
+	tracemalloc.stop()
+	return {
+		"calls": calls,
+		"best": min(times),
+		"median": statistics.median(times),
+		"peakBytes": peak
+	}
+
+def benchmarks(names: list[str]) -> list[Benchmark]:
+	ns = wiki.Namespace.fromFile("Main")
+	assert ns != None
+	# Every benchmark works on the same page from the middle of the wiki
+	history = wiki.PageHistory.fromFile(names[len(names) // 2])
+	assert history != None
+	page = history.mostRecent()
+	content = page.getContent().decode("UTF-8")
+	template = ns.content.encode("UTF-8")
+	encoded = page.toBytes()
+	def save():
+		h = wiki.PageHistory.fromFile(names[0])
+		assert h != None
+		return lambda: (h.appendEdit("Benchmark", "content", b"Edited"), h.save())
+	return [
+		Benchmark("handlebars", lambda: lambda: wiki.handlebars(template, page)),
+		Benchmark("Template.render", lambda: lambda: ns.getTemplate().render(page)),
+		Benchmark("wikitext.parse", lambda: lambda: wikitext.parse(content)),
+		Benchmark("wikitext.wtToHTML", lambda: lambda: wikitext.wtToHTML(content)),
+		Benchmark("Page.toBytes", lambda: lambda: page.toBytes()),
+		Benchmark("Page.read", lambda: lambda: wiki.Page.read(ns, page.name, wiki.Buffer(encoded))),
+		Benchmark("PageHistory.fromFile", lambda: lambda: wiki.PageHistory.fromFile(names[len(names) // 2])),
+		Benchmark("PageHistory.fromFile+decode", lambda: lambda: decodeHistory(names[len(names) // 2])),
+		Benchmark("PageHistory.save", save)
+	]
+
+def decodeHistory(name: str) -> "list[tuple[str, wiki.Page]]":
+	history = wiki.PageHistory.fromFile(name)
+	assert history != None
+	return history.data
+
+def compare(results: dict[str, typing.Any], baseline: dict[str, typing.Any], threshold: float) -> list[str]:
+	# Returns the benchmarks that got slower than baseline by more than threshold
+	slower: list[str] = []
+	for name, result in results["benchmarks"].items():
+		old = baseline["benchmarks"].get(name)
+		if old == None:
+			print(f"{name:32} new")
+			continue
+		ratio = result["best"] / old["best"]
+		memory = result["peakBytes"] / max(1, old["peakBytes"])
+		mark = ""
+		if ratio > threshold:
+			mark = "  SLOWER"
+			slower.append(name)
+		elif ratio < 1 / threshold:
+			mark = "  faster"
+		print(f"{name:32} {ratio:6.2f}x time  {memory:6.2f}x memory{mark}")
+	return slower
+
+def main(args: argparse.Namespace) -> int:
+	directory = tempfile.mkdtemp(prefix="wikibench-")
+	cwd = os.getcwd()
+	try:
+		start = time.perf_counter()
+		names = generateWiki(directory, args.pages, args.revisions, args.field_bytes, args.markup, args.seed)
+		print(f"Generated {len(names)} page(s) with {args.revisions} revision(s) each in {time.perf_counter() - start:.2f}s")
+		os.chdir(directory)
+		results: dict[str, typing.Any] = {
+			"python": sys.version,
+			"parameters": { "pages": args.pages, "revisions": args.revisions, "fieldBytes": args.field_bytes, "markup": args.markup, "seed": args.seed },
+			"benchmarks": {}
+		}
+		for benchmark in benchmarks(names):
+			if args.only != None and not any([o in benchmark.name for o in args.only]): continue
+			result = measure(benchmark, args.repeat, args.min_time)
+			results["benchmarks"][benchmark.name] = result
+			print(f"{benchmark.name:32} {result['best'] * 1e6:12.1f} us  (median {result['median'] * 1e6:.1f} us)  peak {result['peakBytes'] / 1024:.1f} KiB")
+		results["maxRSSKiB"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	finally:
+		os.chdir(cwd)
+		shutil.rmtree(directory)
+	if args.output != None:
+		with open(args.output, "w") as f:
+			json.dump(results, f, indent="\t")
+	if args.baseline != None:
+		with open(args.baseline) as f:
+			baseline = json.load(f)
+		if baseline["parameters"] != results["parameters"]: print("Warning: the baseline was made with different parameters")
+		if len(compare(results, baseline, args.threshold)) > 0: return 1
+	return 0
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Time the wiki's storage, template and markup code on a generated wiki")
+	parser.add_argument("--pages", type=int, default=50, help="Number of pages to generate")
+	parser.add_argument("--revisions", type=int, default=20, help="Revisions per page")
+	parser.add_argument("--field-bytes", type=int, default=4000, help="Approximate size of each content field")
+	parser.add_argument("--markup", type=float, default=0.1, help="Share of words that are bold, italic or links")
+	parser.add_argument("--seed", type=int, default=1, help="Seed for the generated content")
+	parser.add_argument("--repeat", type=int, default=5, help="Timed runs per benchmark")
+	parser.add_argument("--min-time", type=float, default=0.2, help="Seconds each timed run should take at least")
+	parser.add_argument("--only", nargs="*", help="Only run benchmarks whose names contain one of these")
+	parser.add_argument("--output", help="Write the results to this JSON file")
+	parser.add_argument("--baseline", help="Compare with results written earlier by --output")
+	parser.add_argument("--threshold", type=float, default=1.25, help="Slowdown ratio that counts as a regression")
+	sys.exit(main(parser.parse_args()))
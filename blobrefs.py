@@ -0,0 +1,78 @@
+import os
+import time
+import typing
+import blobs
+import pageindex
+import wiki
+
+class BlobReferences(pageindex.PageIndex):
+	# How many times the histories of all pages reference each blob; a blob
+	# nobody references can be deleted. Unlike the other indexes this covers
+	# every revision, not just the newest.
+	def __init__(self, filename: str):
+		super().__init__(filename)
+		self.pages: "dict[str, dict[str, int]]" = {}
+		self.counts: "dict[str, int]" = {}
+	def extract(self, history: wiki.PageHistory) -> dict[str, int]:
+		return { digest.hex(): count for digest, count in history.blobReferences().items() }
+	def update(self, history: wiki.PageHistory, persist: bool = True):
+		# After an append only the new entries are read, and the log gets a
+		# record of what they added to the counts the index already has
+		page = history.ns.name + ":" + history.name
+		base = self.sizes.get(page)
+		if base == None: return super().update(history, persist)
+		# The new entries are the last few, so look for the first of them from the end
+		start = len(history.offsets)
+		while start > 0 and history.offsets[start - 1] >= base: start -= 1
+		if start == 0 or start >= len(history.offsets) or history.offsets[start] != base:
+			return super().update(history, persist)
+		added = { digest.hex(): count for digest, count in history.blobReferences(start).items() }
+		with self.lock:
+			if not self.loaded: return
+			base = self.sizes.get(page)
+			if base != history.offsets[start]: return super().update(history, persist)
+			self.sizes[page] = history.savedBytes
+			self.add(page, added)
+			if persist: self.writeLog({ "page": page, "size": history.savedBytes, "base": base, "added": added })
+	def readRecord(self, record: dict[str, typing.Any]):
+		if "added" not in record: return super().readRecord(record)
+		if self.sizes.get(record["page"]) != record["base"]:
+			# Counts the record was based on are missing; refreshStale reads the page again
+			self.sizes.pop(record["page"], None)
+			return
+		self.sizes[record["page"]] = record["size"]
+		self.add(record["page"], record["added"])
+	def add(self, page: str, added: dict[str, int]):
+		counts = self.pages.setdefault(page, {})
+		for digest, count in added.items():
+			counts[digest] = counts.get(digest, 0) + count
+			self.counts[digest] = self.counts.get(digest, 0) + count
+	def apply(self, page: str, value: "dict[str, int] | None"):
+		for digest, count in self.pages.pop(page, {}).items():
+			self.counts[digest] -= count
+			if self.counts[digest] == 0: del self.counts[digest]
+		if value == None or len(value) == 0: return
+		self.pages[page] = value
+		for digest, count in value.items():
+			self.counts[digest] = self.counts.get(digest, 0) + count
+	def snapshotValue(self, page: str) -> dict[str, int]:
+		return self.pages.get(page, {})
+	def collect(self, graceSeconds: float, dryRun: bool = False) -> tuple[int, int]:
+		# Deletes blobs that nothing references and that were not written or
+		# reused within graceSeconds, which covers saves whose references are
+		# not indexed yet; returns how many blobs and bytes were freed
+		self.load()
+		self.refreshStale()
+		freed = 0
+		freedBytes = 0
+		cutoff = time.time() - graceSeconds
+		for digest, stat in blobs.listBlobs():
+			with self.lock:
+				if digest in self.counts or stat.st_mtime >= cutoff: continue
+			filename = blobs.getFilename(bytes.fromhex(digest))
+			# Look again right before deleting, in case a save just reused it
+			if os.stat(filename).st_mtime >= cutoff: continue
+			if not dryRun: os.remove(filename)
+			freed += 1
+			freedBytes += stat.st_size
+		return (freed, freedBytes)
@@ -0,0 +1,80 @@
+import collections
+import hashlib
+import os
+import threading
+import utils
+
+# Field values stored once, by content. A blob is the file
+# pages/.blobs/<first 2 hex digits>/<SHA-256 in hex>.
+DIRECTORY = "pages/.blobs"
+DIGEST_BYTES = 32
+# Blobs smaller than this are read into memory instead of mapped, since every
+# mapping keeps a file descriptor open for as long as the value is referenced
+mapMinBytes = 1 << 20
+# Recently read blobs, so the many revisions that share a value share one copy
+cacheSize = 256
+cache: "collections.OrderedDict[bytes, bytes | memoryview]" = collections.OrderedDict()
+cacheLock = threading.Lock()
+
+def getFilename(digest: bytes) -> str:
+	name = digest.hex()
+	return f"{DIRECTORY}/{name[:2]}/{name}"
+
+def write(value: "bytes | memoryview") -> bytes:
+	digest = hashlib.sha256(value).digest()
+	filename = getFilename(digest)
+	try:
+		# Already stored; mark it as used now so a collection running at the
+		# same time leaves it alone
+		os.utime(filename)
+	except FileNotFoundError:
+		os.makedirs(os.path.dirname(filename), exist_ok=True)
+		utils.write_file_atomic(filename, value)
+	return digest
+
+def read(digest: "bytes | memoryview") -> "bytes | memoryview":
+	digest = bytes(digest)
+	with cacheLock:
+		if digest in cache:
+			cache.move_to_end(digest)
+			return cache[digest]
+	filename = getFilename(digest)
+	try:
+		size = os.stat(filename).st_size
+	except FileNotFoundError:
+		raise ValueError(f"Blob {digest.hex()} is missing")
+	value = utils.map_file(filename) if size >= mapMinBytes else utils.read_file(filename)
+	if value == None: raise ValueError(f"Blob {digest.hex()} is missing")
+	with cacheLock:
+		cache[digest] = value
+		while len(cache) > cacheSize: cache.popitem(last=False)
+	return value
+
+class Reference:
+	# A field value in the blob store; the blob is only read the first time the
+	# value itself is needed
+	def __init__(self, digest: bytes, length: int):
+		self.digest = digest
+		self.length = length
+		self.value: "bytes | memoryview | None" = None
+	def __len__(self) -> int:
+		return self.length
+	def __bytes__(self) -> bytes:
+		return bytes(self.read())
+	def __eq__(self, other: object) -> bool:
+		if isinstance(other, Reference): return self.digest == other.digest
+		if not isinstance(other, (bytes, memoryview)): return NotImplemented
+		return self.read() == other
+	def read(self) -> "bytes | memoryview":
+		if self.value == None: self.value = read(self.digest)
+		return self.value
+
+def listBlobs() -> "list[tuple[str, os.stat_result]]":
+	# Every stored blob as (hex digest, stat)
+	found: "list[tuple[str, os.stat_result]]" = []
+	if not os.path.isdir(DIRECTORY): return found
+	for prefix in sorted(os.listdir(DIRECTORY)):
+		for name in sorted(os.listdir(f"{DIRECTORY}/{prefix}")):
+			if len(name) != DIGEST_BYTES * 2: continue
+			found.append((name, os.stat(f"{DIRECTORY}/{prefix}/{name}")))
+	return found
@@ -0,0 +1,124 @@
+import collections
+import threading
+import typing
+import utils
+import os
+
+class LRUCache:
+	def __init__(self, maxBytes: int):
+		self.maxBytes = maxBytes
+		self.size = 0
+		self.entries: "collections.OrderedDict[typing.Hashable, bytes]" = collections.OrderedDict()
+		self.hits = 0
+		self.misses = 0
+		self.lock = threading.RLock()
+	def get(self, key: typing.Hashable) -> bytes | None:
+		with self.lock:
+			value = self.entries.get(key)
+			if value == None:
+				self.misses += 1
+				return None
+			self.entries.move_to_end(key)
+			self.hits += 1
+			return value
+	def put(self, key: typing.Hashable, value: bytes):
+		with self.lock:
+			if key in self.entries: self.remove(key)
+			if len(value) > self.maxBytes: return
+			self.entries[key] = value
+			self.size += len(value)
+			self.added(key)
+			while self.size > self.maxBytes:
+				self.remove(next(iter(self.entries)))
+	def remove(self, key: typing.Hashable):
+		with self.lock:
+			value = self.entries.pop(key)
+			self.size -= len(value)
+			self.removed(key)
+	def added(self, key: typing.Hashable):
+		pass
+	def removed(self, key: typing.Hashable):
+		pass
+	def clear(self):
+		with self.lock:
+			for key in [*self.entries.keys()]:
+				self.remove(key)
+
+class RenderCache(LRUCache):
+	def __init__(self, maxBytes: int):
+		super().__init__(maxBytes)
+		# Keys are (namespace, page, revision count)
+		self.pages: "dict[tuple[str, str], set[tuple[str, str, int]]]" = {}
+		# Tags identify what else went into a rendering (the template, which links
+		# were red), so an entry with a different tag is stale
+		self.tags: "dict[tuple[str, str, int], str]" = {}
+	def getPage(self, ns: str, name: str, revisions: int, tag: str) -> bytes | None:
+		key = (ns, name, revisions)
+		with self.lock:
+			if key in self.tags and self.tags[key] != tag:
+				self.remove(key)
+			return self.get(key)
+	def putPage(self, ns: str, name: str, revisions: int, tag: str, content: bytes):
+		key = (ns, name, revisions)
+		with self.lock:
+			self.put(key, content)
+			if key in self.entries: self.tags[key] = tag
+	def added(self, key: typing.Hashable):
+		key = typing.cast("tuple[str, str, int]", key)
+		self.pages.setdefault((key[0], key[1]), set()).add(key)
+	def removed(self, key: typing.Hashable):
+		key = typing.cast("tuple[str, str, int]", key)
+		self.tags.pop(key, None)
+		keys = self.pages[(key[0], key[1])]
+		keys.discard(key)
+		if len(keys) == 0: del self.pages[(key[0], key[1])]
+	def invalidate(self, ns: str, name: str | None = None):
+		with self.lock:
+			if name == None:
+				pages = [p for p in self.pages.keys() if p[0] == ns]
+			else:
+				pages = [(ns, name)]
+			for page in pages:
+				for key in [*self.pages.get(page, ())]:
+					self.remove(key)
+
+class ChangeLog:
+	# Processes serving the same pages/ append the names of pages they change here,
+	# and read what the others appended to drop their own stale cache entries.
+	# Each line is "<pid> <name>", so a process can skip the changes it made.
+	maxBytes = 1024 * 1024
+	def __init__(self, filename: str):
+		self.filename = filename
+		self.lock = threading.Lock()
+		if not os.path.exists(filename): utils.write_file_atomic(filename, b"")
+		stat = os.stat(filename)
+		self.inode = stat.st_ino
+		self.pos = stat.st_size
+	def record(self, name: str):
+		fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+		try:
+			os.write(fd, f"{os.getpid()} {name}\n".encode("UTF-8"))
+			size = os.fstat(fd).st_size
+		finally:
+			os.close(fd)
+		if size > self.maxBytes:
+			# Start a new log; readers notice the new inode and start over
+			utils.write_file_atomic(self.filename, b"")
+	def poll(self) -> list[str] | None:
+		# Returns the names recorded since the last poll, or None if the log was
+		# replaced and everything should be considered changed.
+		with self.lock:
+			try:
+				stat = os.stat(self.filename)
+			except FileNotFoundError:
+				return []
+			if stat.st_ino != self.inode:
+				self.inode = stat.st_ino
+				self.pos = stat.st_size
+				return None
+			if stat.st_size <= self.pos: return []
+			raw = utils.read_file_range(self.filename, self.pos, stat.st_size)
+			end = raw.rfind(b"\n") + 1
+			self.pos += end
+			own = str(os.getpid())
+			return [name for pid, name in [line.split(" ", 1) for line in raw[:end].decode("UTF-8").splitlines()] if pid != own]
@@ -0,0 +1,78 @@
+import bisect
+import os
+import time
+import typing
+import config
+import pageindex
+import wiki
+
+class PageInfo(typing.NamedTuple):
+	name: str
+	live: bool
+	revisions: int
+	modified: float
+
+class PageCatalog(pageindex.PageIndex):
+	# Every page of every namespace with its status, so pages can be listed
+	# without reading the directories
+	def __init__(self, filename: str):
+		super().__init__(filename)
+		self.info: "dict[str, dict[str, PageInfo]]" = {}
+		# Sorted names of the live pages, or of all pages, of a namespace; built
+		# when first listed
+		self.sortedNames: "dict[tuple[str, bool], list[str]]" = {}
+		self.namespaceList: list[str] = []
+		self.namespacesChecked = 0.0
+	def extract(self, history: wiki.PageHistory) -> dict[str, typing.Any]:
+		return {
+			"live": history.exists(),
+			"revisions": len(history),
+			"modified": os.path.getmtime(history.getFilename())
+		}
+	def apply(self, page: str, value: "dict[str, typing.Any] | None"):
+		ns, name = page.split(":", 1)
+		pages = self.info.setdefault(ns, {})
+		old = pages.pop(name, None)
+		new = None
+		if value != None:
+			new = PageInfo(name, value["live"], value["revisions"], value["modified"])
+			pages[name] = new
+		for includeDeleted in [True, False]:
+			names = self.sortedNames.get((ns, includeDeleted))
+			if names == None: continue
+			listed = old != None and (includeDeleted or old.live)
+			shown = new != None and (includeDeleted or new.live)
+			if listed and not shown: names.pop(bisect.bisect_left(names, name))
+			if shown and not listed: bisect.insort(names, name)
+	def snapshotValue(self, page: str) -> dict[str, typing.Any]:
+		ns, name = page.split(":", 1)
+		info = self.info[ns][name]
+		return { "live": info.live, "revisions": info.revisions, "modified": info.modified }
+	def listNamespaces(self) -> list[str]:
+		# New namespaces are made by hand, so look for them now and then
+		if time.monotonic() - self.namespacesChecked >= config.checkInterval:
+			self.namespaceList = wiki.listNamespaces()
+			self.namespacesChecked = time.monotonic()
+		return self.namespaceList
+	def getNames(self, ns: str, includeDeleted: bool) -> list[str]:
+		names = self.sortedNames.get((ns, includeDeleted))
+		if names == None:
+			pages = self.info.get(ns, {})
+			names = sorted([name for name, info in pages.items() if includeDeleted or info.live])
+			self.sortedNames[(ns, includeDeleted)] = names
+		return names
+	def count(self, ns: str, includeDeleted: bool = False) -> int:
+		self.load()
+		with self.lock:
+			return len(self.getNames(ns, includeDeleted))
+	def listPages(self, ns: str, prefix: str = "", offset: int = 0, limit: int = 100, includeDeleted: bool = False) -> tuple[int, list[PageInfo]]:
+		# Pages of ns starting with prefix in name order; returns how many match
+		# and the ones from offset to offset + limit
+		self.load()
+		with self.lock:
+			names = self.getNames(ns, includeDeleted)
+			start = bisect.bisect_left(names, prefix)
+			end = len(names)
+			if prefix != "": end = bisect.bisect_left(names, prefix[:-1] + chr(ord(prefix[-1]) + 1), start)
+			pages = self.info.get(ns, {})
+			return (end - start, [pages[name] for name in names[start + offset:min(end, start + offset + limit)]])
@@ -0,0 +1,51 @@
+import threading
+import typing
+import weakref
+import time
+import utils
+import os
+
+T = typing.TypeVar('T')
+
+# How long (in seconds) a loaded file is trusted before its mtime/inode are checked again
+checkInterval = 1.0
+
+class WatchedFile(typing.Generic[T]):
+	instances: "weakref.WeakSet[WatchedFile[typing.Any]]" = weakref.WeakSet()
+	def __init__(self, filename: str, parse: typing.Callable[[bytes], T]):
+		self.filename = filename
+		self.parse = parse
+		self.lock = threading.Lock()
+		self.value: T | None = None
+		# (inode, mtime, size) of the file self.value was parsed from
+		self.stamp: tuple[int, int, int] | None = None
+		self.checked = -checkInterval
+		WatchedFile.instances.add(self)
+	def get(self) -> T | None:
+		if time.monotonic() - self.checked < checkInterval: return self.value
+		with self.lock:
+			self.checked = time.monotonic()
+			try:
+				stat = os.stat(self.filename)
+			except FileNotFoundError:
+				self.value = None
+				self.stamp = None
+				return None
+			stamp = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+			if stamp != self.stamp:
+				raw = utils.read_file(self.filename)
+				try:
+					self.value = None if raw == None else self.parse(raw)
+					self.stamp = stamp
+				except (ValueError, KeyError):
+					# Probably caught halfway through being written; keep the old value
+					self.checked = -checkInterval
+			return self.value
+	def reload(self):
+		with self.lock:
+			self.stamp = None
+			self.checked = -checkInterval
+
+def reloadAll():
+	for watched in [*WatchedFile.instances]:
+		watched.reload()
@@ -0,0 +1,109 @@
+import typing
+
+# Operations in a diff: a line both sides share, one only the old side has, and
+# one only the new side has
+EQUAL = " "
+DELETE = "-"
+INSERT = "+"
+
+# Give up on finding the shortest diff past this many edits in one range, and
+# report the rest of the range as replaced; keeps huge rewrites from taking
+# quadratic time
+maxEdits = 1000
+
+def middleSnake(a: list[int], aLo: int, aHi: int, b: list[int], bLo: int, bHi: int) -> "tuple[int, int, int, int] | None":
+	# Myers' linear space refinement: walk the edit graph from both corners at
+	# once until the paths overlap, and return the overlapping diagonal run
+	# (x, y) -> (u, v), relative to aLo and bLo
+	n = aHi - aLo
+	m = bHi - bLo
+	delta = n - m
+	odd = delta % 2 == 1
+	limit = min((n + m + 1) // 2, maxEdits)
+	offset = limit + 1
+	forward = [0] * (2 * limit + 3)
+	backward = [0] * (2 * limit + 3)
+	for d in range(limit + 1):
+		for k in range(-d, d + 1, 2):
+			if k == -d or (k != d and forward[offset + k - 1] < forward[offset + k + 1]):
+				x = forward[offset + k + 1]
+			else:
+				x = forward[offset + k - 1] + 1
+			y = x - k
+			x0, y0 = x, y
+			while x < n and y < m and a[aLo + x] == b[bLo + y]:
+				x += 1
+				y += 1
+			forward[offset + k] = x
+			c = delta - k
+			if odd and -d < c < d and x + backward[offset + c] >= n:
+				return (x0, y0, x, y)
+		for c in range(-d, d + 1, 2):
+			if c == -d or (c != d and backward[offset + c - 1] < backward[offset + c + 1]):
+				x = backward[offset + c + 1]
+			else:
+				x = backward[offset + c - 1] + 1
+			y = x - c
+			x0, y0 = x, y
+			while x < n and y < m and a[aHi - 1 - x] == b[bHi - 1 - y]:
+				x += 1
+				y += 1
+			backward[offset + c] = x
+			k = delta - c
+			if not odd and -d <= k <= d and x + forward[offset + k] >= n:
+				return (n - x, m - y, n - x0, m - y0)
+	return None
+
+def diffLines(old: list[str], new: list[str]) -> list[tuple[str, str]]:
+	ids: dict[str, int] = {}
+	a = [ids.setdefault(line, len(ids)) for line in old]
+	b = [ids.setdefault(line, len(ids)) for line in new]
+	ops: list[tuple[str, str]] = []
+	def diffRange(aLo: int, aHi: int, bLo: int, bHi: int):
+		start = aLo
+		while aLo < aHi and bLo < bHi and a[aLo] == b[bLo]:
+			aLo += 1
+			bLo += 1
+		ops.extend([(EQUAL, line) for line in old[start:aLo]])
+		end = aHi
+		while aLo < aHi and bLo < bHi and a[aHi - 1] == b[bHi - 1]:
+			aHi -= 1
+			bHi -= 1
+		snake = None
+		if aLo < aHi and bLo < bHi: snake = middleSnake(a, aLo, aHi, b, bLo, bHi)
+		if snake == None:
+			ops.extend([(DELETE, line) for line in old[aLo:aHi]])
+			ops.extend([(INSERT, line) for line in new[bLo:bHi]])
+		else:
+			x, y, u, v = snake
+			diffRange(aLo, aLo + x, bLo, bLo + y)
+			ops.extend([(EQUAL, line) for line in old[aLo + x:aLo + u]])
+			diffRange(aLo + u, aHi, bLo + v, bHi)
+		ops.extend([(EQUAL, line) for line in old[aHi:end]])
+	diffRange(0, len(a), 0, len(b))
+	return ops
+
+def hunks(ops: list[tuple[str, str]], context: int = 3) -> "typing.Iterator[tuple[str, list[tuple[str, str]]]]":
+	# Groups changes with a few lines around them, yielding each group with its
+	# "@@ -start,count +start,count @@" header
+	changed = [i for i, op in enumerate(ops) if op[0] != EQUAL]
+	i = 0
+	pos = 0
+	oldLine = 0
+	newLine = 0
+	while i < len(changed):
+		first = changed[i]
+		last = first
+		while i + 1 < len(changed) and changed[i + 1] - last <= 2 * context:
+			i += 1
+			last = changed[i]
+		i += 1
+		lo = max(0, first - context)
+		hi = min(len(ops), last + context + 1)
+		for op in ops[pos:lo]:
+			if op[0] != INSERT: oldLine += 1
+			if op[0] != DELETE: newLine += 1
+		pos = lo
+		oldCount = sum([1 for op in ops[lo:hi] if op[0] != INSERT])
+		newCount = sum([1 for op in ops[lo:hi] if op[0] != DELETE])
+		yield (f"@@ -{oldLine + 1},{oldCount} +{newLine + 1},{newCount} @@", ops[lo:hi])
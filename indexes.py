@@ -0,0 +1,19 @@
+import json
+import blobrefs
+import catalog
+import config
+import links
+import pageindex
+import search
+import utils
+
+# Everything kept on disk about pages/ besides the pages themselves, shared by
+# the server and the maintenance commands
+settingsFile = config.WatchedFile("settings.json", json.loads)
+searchIndex = search.SearchIndex("pages/.search")
+linkGraph = links.LinkGraph("pages/.links", lambda: utils.optional(settingsFile.get(), {}).get("defaultNS", "Main"))
+# Everything derived from the newest revision of each page
+livePages = links.LivePages("pages/.live")
+pageCatalog = catalog.PageCatalog("pages/.catalog")
+blobReferences = blobrefs.BlobReferences("pages/.blobrefs")
+pageIndexes: list[pageindex.PageIndex] = [searchIndex, linkGraph, livePages, pageCatalog, blobReferences]
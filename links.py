@@ -0,0 +1,61 @@
+import typing
+import pageindex
+import wiki
+import wikitext
+
+class LinkGraph(pageindex.PageIndex):
+	# Which pages each page links to, and which pages link to it
+	def __init__(self, filename: str, defaultNS: typing.Callable[[], str]):
+		super().__init__(filename)
+		self.defaultNS = defaultNS
+		self.outgoing: "dict[str, list[str]]" = {}
+		self.incoming: "dict[str, set[str]]" = {}
+	def resolve(self, target: str) -> str | None:
+		# Mirrors how /wiki/<target> is redirected
+		if target == "": return None
+		if ":" in target: return target
+		ns = wiki.Namespace.fromFile(target) if wiki.isNamespace(target) else None
+		if ns != None: return ns.name + ":" + ns.defaultPage
+		return self.defaultNS() + ":" + target
+	def extract(self, history: wiki.PageHistory) -> list[str]:
+		content = history.mostRecent().getContent().decode("UTF-8", "replace")
+		targets = set([self.resolve(t) for t in wikitext.findLinks(content)])
+		return sorted([t for t in targets if t != None])
+	def apply(self, page: str, value: "list[str] | None"):
+		for target in self.outgoing.pop(page, []):
+			pages = self.incoming[target]
+			pages.discard(page)
+			if len(pages) == 0: del self.incoming[target]
+		if value == None or len(value) == 0: return
+		self.outgoing[page] = value
+		for target in value:
+			self.incoming.setdefault(target, set()).add(page)
+	def snapshotValue(self, page: str) -> list[str]:
+		return self.outgoing.get(page, [])
+	def linksFrom(self, page: str) -> list[str]:
+		self.load()
+		with self.lock:
+			return [*self.outgoing.get(page, [])]
+	def linksTo(self, page: str) -> list[str]:
+		self.load()
+		with self.lock:
+			return sorted(self.incoming.get(page, set()))
+
+class LivePages(pageindex.PageIndex):
+	# Pages that exist and have not been deleted, so links can be checked without
+	# touching the disk
+	def __init__(self, filename: str):
+		super().__init__(filename)
+		self.live: "set[str]" = set()
+	def extract(self, history: wiki.PageHistory) -> bool:
+		return history.exists()
+	def apply(self, page: str, value: "bool | None"):
+		if value:
+			self.live.add(page)
+		else:
+			self.live.discard(page)
+	def snapshotValue(self, page: str) -> bool:
+		return page in self.live
+	def isLive(self, page: str) -> bool:
+		if not self.loaded: self.load()
+		return page in self.live
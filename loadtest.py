@@ -0,0 +1,225 @@
+import argparse
+import concurrent.futures
+import http.client
+import json
+import math
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import typing
+import bench
+
+ROUTES = ["wiki", "history", "data", "edit", "create"]
+# How long after the end of the run a response may still take
+STALL_SECONDS = 5
+
+def parseMix(mix: str) -> dict[str, float]:
+	# "wiki=80,edit=20" -> share of requests per route
+	weights: dict[str, float] = {}
+	for part in mix.split(","):
+		route, _, weight = part.partition("=")
+		if route not in ROUTES: raise SystemExit(f"Unknown route {route!r} in --mix; use {', '.join(ROUTES)}")
+		weights[route] = float(weight)
+	return weights
+
+def makeRequest(route: str, rng: random.Random, pages: int, client: str, n: int) -> tuple[str, str, bytes | None]:
+	page = f"Main:Page_{rng.randrange(pages)}"
+	if route == "wiki": return ("GET", f"/wiki/{page}", None)
+	if route == "history": return ("GET", f"/wiki_history/{page}", None)
+	if route == "data": return ("GET", f"/get_data/{page}/content", None)
+	if route == "edit":
+		content = bench.generateContent(rng, 500, 0.1, pages)
+		return ("POST", f"/edit/{page}/content", f"Load test edit {n}\n{content}".encode("UTF-8"))
+	return ("POST", "/create", f"Main\nLoad_{client}_{n}\nLoad test page".encode("UTF-8"))
+
+def runClient(host: str, port: int, threads: int, duration: float, mix: dict[str, float], pages: int, seed: int) -> dict[str, typing.Any]:
+	# Runs threads connections for duration seconds; returns the latency of each
+	# successful request and the errors, per route, and how many responses each
+	# connection got. A request still waiting for its response a few seconds
+	# after the deadline counts as an error.
+	latencies: dict[str, list[float]] = { route: [] for route in mix.keys() }
+	errors: dict[str, dict[str, int]] = { route: {} for route in mix.keys() }
+	completed = [0] * threads
+	inFlight: list[str | None] = [None] * threads
+	stopped = False
+	lock = threading.Lock()
+	deadline = time.monotonic() + duration
+	def client(index: int):
+		rng = random.Random(seed * 1000 + index)
+		name = f"{os.getpid()}_{index}"
+		routes = [*mix.keys()]
+		weights = [*mix.values()]
+		connection = http.client.HTTPConnection(host, port, timeout=30)
+		n = 0
+		while time.monotonic() < deadline:
+			route = rng.choices(routes, weights)[0]
+			method, path, body = makeRequest(route, rng, pages, name, n)
+			n += 1
+			error = None
+			with lock: inFlight[index] = route
+			start = time.perf_counter()
+			try:
+				connection.request(method, path, body)
+				response = connection.getresponse()
+				response.read()
+				if response.status >= 400: error = f"HTTP {response.status}"
+			except (OSError, http.client.HTTPException) as e:
+				error = type(e).__name__
+				connection.close()
+				connection = http.client.HTTPConnection(host, port, timeout=30)
+			elapsed = time.perf_counter() - start
+			with lock:
+				if stopped: return
+				inFlight[index] = None
+				if error == None:
+					latencies[route].append(elapsed)
+					completed[index] += 1
+				else:
+					errors[route][error] = errors[route].get(error, 0) + 1
+		connection.close()
+	workers = [threading.Thread(target=client, args=(i,), daemon=True) for i in range(threads)]
+	for worker in workers: worker.start()
+	for worker in workers: worker.join(max(0, deadline - time.monotonic()) + STALL_SECONDS)
+	with lock:
+		stopped = True
+		for route in inFlight:
+			if route != None: errors[route]["no response"] = errors[route].get("no response", 0) + 1
+		return { "latencies": latencies, "errors": errors, "completed": completed }
+
+def percentile(values: list[float], p: float) -> float:
+	if len(values) == 0: return 0.0
+	return values[max(0, math.ceil(p * len(values)) - 1)]
+
+def freePort() -> int:
+	with socket.socket() as s:
+		s.bind(("127.0.0.1", 0))
+		return s.getsockname()[1]
+
+def startServer(directory: str, port: int) -> subprocess.Popen[bytes]:
+	server = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")], cwd=directory, stdout=subprocess.DEVNULL)
+	# The server indexes the generated pages before it starts listening
+	deadline = time.monotonic() + 120
+	while time.monotonic() < deadline:
+		if server.poll() != None: raise SystemExit("The server exited while starting")
+		try:
+			socket.create_connection(("127.0.0.1", port), 1).close()
+			return server
+		except OSError:
+			time.sleep(0.1)
+	server.kill()
+	raise SystemExit("The server did not start listening")
+
+def report(results: dict[str, typing.Any], duration: float) -> dict[str, typing.Any]:
+	summary: dict[str, typing.Any] = {}
+	allLatencies: list[float] = []
+	totalErrors = 0
+	for route in results["latencies"].keys():
+		latencies = sorted(results["latencies"][route])
+		errors = sum(results["errors"][route].values())
+		allLatencies.extend(latencies)
+		totalErrors += errors
+		summary[route] = {
+			"requests": len(latencies) + errors,
+			"throughput": len(latencies) / duration,
+			"p50": percentile(latencies, 0.5),
+			"p95": percentile(latencies, 0.95),
+			"p99": percentile(latencies, 0.99),
+			"max": latencies[-1] if len(latencies) > 0 else 0.0,
+			"errors": errors,
+			"errorKinds": results["errors"][route]
+		}
+	allLatencies.sort()
+	summary["total"] = {
+		"requests": len(allLatencies) + totalErrors,
+		"throughput": len(allLatencies) / duration,
+		"p50": percentile(allLatencies, 0.5),
+		"p95": percentile(allLatencies, 0.95),
+		"p99": percentile(allLatencies, 0.99),
+		"max": allLatencies[-1] if len(allLatencies) > 0 else 0.0,
+		"errors": totalErrors,
+		"errorKinds": {}
+	}
+	print(f"{'route':10} {'requests':>9} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9} {'errors':>7}")
+	for route, r in summary.items():
+		print(f"{route:10} {r['requests']:9} {r['throughput']:9.1f} {r['p50'] * 1000:9.2f} {r['p95'] * 1000:9.2f} {r['p99'] * 1000:9.2f} {r['max'] * 1000:9.2f} {r['errors']:7}")
+		for kind, count in r["errorKinds"].items():
+			print(f"{'':10} {count:9} x {kind}")
+	# A server that starves some connections can look fast from the others
+	completed = sorted(results["completed"])
+	summary["connections"] = {
+		"count": len(completed),
+		"starved": len([c for c in completed if c == 0]),
+		"minCompleted": completed[0] if len(completed) > 0 else 0,
+		"medianCompleted": completed[len(completed) // 2] if len(completed) > 0 else 0,
+		"maxCompleted": completed[-1] if len(completed) > 0 else 0
+	}
+	c = summary["connections"]
+	print(f"{c['count']} connection(s), {c['starved']} without any response; responses per connection min {c['minCompleted']}, median {c['medianCompleted']}, max {c['maxCompleted']}")
+	return summary
+
+def main(args: argparse.Namespace):
+	mix = parseMix(args.mix)
+	directory = tempfile.mkdtemp(prefix="wikiload-")
+	server = None
+	try:
+		bench.generateWiki(directory, args.pages, args.revisions, args.field_bytes, args.markup, args.seed)
+		shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), "style.css"), f"{directory}/style.css")
+		port = freePort()
+		with open(f"{directory}/settings.json") as f:
+			settings = json.load(f)
+		settings.update({ "host": "127.0.0.1", "port": port, "workers": args.workers, "processes": args.processes })
+		with open(f"{directory}/settings.json", "w") as f:
+			json.dump(settings, f, indent="\t")
+		server = startServer(directory, port)
+		print(f"Serving {args.pages} generated page(s) from {directory} with {args.processes} process(es) x {args.workers} worker(s)")
+		# Clients run in several processes so they don't all share one interpreter lock
+		processes = max(1, min(args.client_processes, args.concurrency))
+		threads = [args.concurrency // processes + (1 if i < args.concurrency % processes else 0) for i in range(processes)]
+		results: dict[str, typing.Any] = { "latencies": { route: [] for route in mix.keys() }, "errors": { route: {} for route in mix.keys() }, "completed": [] }
+		with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+			futures = [pool.submit(runClient, "127.0.0.1", port, threads[i], args.duration, mix, args.pages, args.seed + i) for i in range(processes)]
+			for future in futures:
+				result = future.result()
+				results["completed"].extend(result["completed"])
+				for route in mix.keys():
+					results["latencies"][route].extend(result["latencies"][route])
+					for kind, count in result["errors"][route].items():
+						results["errors"][route][kind] = results["errors"][route].get(kind, 0) + count
+		summary = report(results, args.duration)
+		if args.output != None:
+			with open(args.output, "w") as f:
+				json.dump({
+					"parameters": { **vars(args), "mix": mix },
+					"routes": summary
+				}, f, indent="\t")
+	finally:
+		if server != None:
+			server.send_signal(signal.SIGTERM)
+			try:
+				server.wait(10)
+			except subprocess.TimeoutExpired:
+				server.kill()
+		shutil.rmtree(directory)
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Run main.py on a generated wiki and measure it under concurrent traffic")
+	parser.add_argument("--pages", type=int, default=200, help="Number of pages to generate")
+	parser.add_argument("--revisions", type=int, default=10, help="Revisions per page")
+	parser.add_argument("--field-bytes", type=int, default=4000, help="Approximate size of each content field")
+	parser.add_argument("--markup", type=float, default=0.1, help="Share of words that are bold, italic or links")
+	parser.add_argument("--seed", type=int, default=1, help="Seed for the generated wiki and the request mix")
+	parser.add_argument("--mix", default="wiki=70,history=5,data=10,edit=10,create=5", help="Relative share of each route")
+	parser.add_argument("--concurrency", type=int, default=16, help="Number of connections sending requests")
+	parser.add_argument("--client-processes", type=int, default=os.cpu_count() or 1, help="Processes the connections are spread over")
+	parser.add_argument("--duration", type=float, default=10, help="Seconds to send requests for")
+	parser.add_argument("--workers", type=int, default=16, help="Server worker threads per process")
+	parser.add_argument("--processes", type=int, default=1, help="Server processes")
+	parser.add_argument("--output", help="Write the results to this JSON file")
+	main(parser.parse_args())
@@ -0,0 +1,93 @@
+import contextlib
+import threading
+import typing
+import weakref
+import zlib
+import os
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+
+# Pages are spread over a fixed number of lock files, shared by every process using pages/
+lockDir = "pages/.locks"
+LOCK_STRIPES = 256
+
+@contextlib.contextmanager
+def fileLock(name: str, exclusive: bool) -> typing.Iterator[None]:
+	if fcntl == None:
+		yield
+		return
+	os.makedirs(lockDir, exist_ok=True)
+	stripe = zlib.crc32(name.encode("UTF-8")) % LOCK_STRIPES
+	# Every holder opens its own descriptor, so flock also excludes threads of the same process
+	fd = os.open(f"{lockDir}/{stripe}", os.O_RDWR | os.O_CREAT, 0o644)
+	try:
+		fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+		yield
+	finally:
+		os.close(fd)
+
+class ReadWriteLock:
+	def __init__(self, name: str | None = None):
+		# Named locks also take the matching file lock, for other processes
+		self.name = name
+		self.condition = threading.Condition()
+		self.readers = 0
+		self.writer = False
+		self.waitingWriters = 0
+	def acquireRead(self):
+		with self.condition:
+			# Writers go first, so a steady stream of readers can't starve them
+			while self.writer or self.waitingWriters > 0:
+				self.condition.wait()
+			self.readers += 1
+	def releaseRead(self):
+		with self.condition:
+			self.readers -= 1
+			if self.readers == 0: self.condition.notify_all()
+	def acquireWrite(self):
+		with self.condition:
+			self.waitingWriters += 1
+			while self.writer or self.readers > 0:
+				self.condition.wait()
+			self.waitingWriters -= 1
+			self.writer = True
+	def releaseWrite(self):
+		with self.condition:
+			self.writer = False
+			self.condition.notify_all()
+	@contextlib.contextmanager
+	def reading(self) -> typing.Iterator[None]:
+		self.acquireRead()
+		try:
+			if self.name == None:
+				yield
+			else:
+				with fileLock(self.name, False):
+					yield
+		finally:
+			self.releaseRead()
+	@contextlib.contextmanager
+	def writing(self) -> typing.Iterator[None]:
+		self.acquireWrite()
+		try:
+			if self.name == None:
+				yield
+			else:
+				with fileLock(self.name, True):
+					yield
+		finally:
+			self.releaseWrite()
+
+# One lock per page name ("NS:Page"); unused locks are dropped automatically.
+pageLocks: "weakref.WeakValueDictionary[str, ReadWriteLock]" = weakref.WeakValueDictionary()
+pageLocksLock = threading.Lock()
+
+def pageLock(name: str) -> ReadWriteLock:
+	with pageLocksLock:
+		lock = pageLocks.get(name)
+		if lock == None:
+			lock = ReadWriteLock(name)
+			pageLocks[name] = lock
+		return lock
@@ -3,17 +3,158 @@ import typing
 import wiki
 import wikitext
 import utils
+import cache
+import diff
+import indexes
+import pageindex
+import profiling
+import config
+import locks
+import metrics
+import concurrent.futures
+import selectors
+import threading
+import signal
+import zlib
+import gzip
+import hashlib
 import json
+import html
+import sys
+import urllib.parse
 import os
+import time
 
-hostName = "0.0.0.0"
-serverPort = 8087
+settingsFile = indexes.settingsFile
+# Values read once at startup; anything looked up per request goes through settingsFile
+settings = utils.optional(settingsFile.get(), {})
+hostName: str = settings.get("host", "0.0.0.0")
+serverPort: int = settings.get("port", 8087)
+renderCache = cache.RenderCache(settings.get("renderCacheBytes", 64 * 1024 * 1024))
+workers: int = settings.get("workers", 16)
+processes: int = settings.get("processes", 1)
+# Responses smaller than this are sent uncompressed
+compressMinBytes: int = settings.get("compressMinBytes", 1024)
+# gzip variants of responses that have an ETag, keyed by (path, ETag)
+compressedCache = cache.LRUCache(settings.get("compressedCacheBytes", 32 * 1024 * 1024))
+# Only needed when several processes serve the same pages/ directory
+changeLog: cache.ChangeLog | None = None
+wiki.configureStorage(settings)
+# One JSON line per request when set; "-" logs to stderr
+accessLogFile: str | None = settings.get("accessLog")
+accessLog: typing.TextIO | None = None
+accessLogLock = threading.Lock()
+if accessLogFile == "-":
+	accessLog = sys.stderr
+elif accessLogFile != None:
+	accessLog = open(accessLogFile, "a", buffering=1)
+
+metrics.registry.describe("wiki_requests_total", "counter", "Requests handled, by route and status")
+metrics.registry.describe("wiki_request_duration_seconds", "histogram", "Time spent handling requests, by route")
+metrics.registry.describe("wiki_stage_seconds", "histogram", "Time spent in each step of handling requests")
+metrics.registry.describe("wiki_cache_hits_total", "counter", "Cache lookups that found an entry")
+metrics.registry.describe("wiki_cache_misses_total", "counter", "Cache lookups that found nothing")
+metrics.registry.describe("wiki_cache_bytes", "gauge", "Size of everything in a cache")
+metrics.registry.collect(lambda: [
+	(name, { "cache": label }, value)
+	for label, c in [("render", renderCache), ("compressed", compressedCache)]
+	for name, value in [("wiki_cache_hits_total", c.hits), ("wiki_cache_misses_total", c.misses), ("wiki_cache_bytes", c.size)]
+])
+
+def pageChanged(history: wiki.PageHistory):
+	renderCache.invalidate(history.ns.name, history.name)
+	for index in indexes.pageIndexes: index.update(history)
+	if changeLog != None: changeLog.record(history.ns.name + ":" + history.name)
+
+def syncChanges():
+	if changeLog == None: return
+	changed = changeLog.poll()
+	if changed == None:
+		renderCache.clear()
+		for index in indexes.pageIndexes: index.refreshStale()
+		return
+	for name in dict.fromkeys(changed):
+		if name == "*":
+			config.reloadAll()
+			renderCache.clear()
+		else:
+			renderCache.invalidate(name.split(":")[0], name.split(":")[1])
+			history = pageindex.readHistory(name)
+			if history == None: continue
+			# The process that made the change already logged it to disk
+			for index in indexes.pageIndexes:
+				if index.loaded: index.update(history, False)
 
 class HTTPResponse(typing.TypedDict):
 	status: int
 	headers: dict[str, str]
 	content: bytes
 
+# Details of the request being handled by the current thread
+request = threading.local()
+
+def requestHeader(name: str) -> str | None:
+	headers = getattr(request, "headers", None)
+	if headers == None: return None
+	return headers.get(name)
+
+def etagMatches(etag: str) -> bool:
+	header = requestHeader("If-None-Match")
+	if header == None: return False
+	if header.strip() == "*": return True
+	return etag in [t.strip().removeprefix("W/") for t in header.split(",")]
+
+def acceptsGzip() -> bool:
+	header = requestHeader("Accept-Encoding")
+	if header == None: return False
+	for coding in header.split(","):
+		params = [p.strip() for p in coding.split(";")]
+		if params[0].lower() not in ("gzip", "*"): continue
+		q = 1.0
+		for p in params[1:]:
+			if p.startswith("q="):
+				try:
+					q = float(p[2:])
+				except ValueError:
+					q = 0
+		return q > 0
+	return False
+
+def compressible(contentType: str) -> bool:
+	return contentType.startswith("text/") or contentType == "application/json"
+
+def compressResponse(path: str, res: HTTPResponse) -> HTTPResponse:
+	if not compressible(res["headers"].get("Content-Type", "")): return res
+	headers = {**res["headers"], "Vary": "Accept-Encoding"}
+	if not acceptsGzip():
+		return { "status": res["status"], "headers": headers, "content": res["content"] }
+	etag = headers.get("ETag")
+	if etag != None:
+		# The compressed bytes are a different representation of the same
+		# content. Small responses get the weak tag too, so a 304 can send the
+		# same tag without knowing the size.
+		headers["ETag"] = "W/" + etag.removeprefix("W/")
+	if len(res["content"]) < compressMinBytes:
+		return { "status": res["status"], "headers": headers, "content": res["content"] }
+	compressed = compressedCache.get((path, etag)) if etag != None else None
+	if compressed == None:
+		compressed = gzip.compress(res["content"], 6)
+		if etag != None: compressedCache.put((path, etag), compressed)
+	headers["Content-Encoding"] = "gzip"
+	return { "status": res["status"], "headers": headers, "content": compressed }
+
+def notModified(etag: str, contentType: str) -> HTTPResponse:
+	# Carries the same ETag and Vary as the 200 it stands in for
+	headers = { "ETag": etag }
+	if compressible(contentType):
+		headers["Vary"] = "Accept-Encoding"
+		if acceptsGzip(): headers["ETag"] = "W/" + etag.removeprefix("W/")
+	return {
+		"status": 304,
+		"headers": headers,
+		"content": b""
+	}
+
 class HTTPDirective:
 	def __init__(self):
 		self.directions: "dict[str, HTTPDirective] | typing.Callable[[ str, bytes ], HTTPResponse]" = {}
@@ -39,7 +180,14 @@ class HTTPDirective:
 					return self.directions[path[0]].get(path[1:], body)
 			else:
 				return self.directions("/".join(path), body)
+	def record(self, method: str, path: list[str], status: int, start: float):
+		# Routes are named after the first path segment, so labels stay few
+		route = "other"
+		if len(path) > 0 and isinstance(self.directions, dict) and path[0] in self.directions: route = path[0]
+		metrics.registry.increment("wiki_requests_total", { "method": method, "route": route, "status": str(status) })
+		metrics.registry.observe("wiki_request_duration_seconds", { "method": method, "route": route }, time.perf_counter() - start)
 	def root_get(self, _path: str) -> HTTPResponse:
+		start = time.perf_counter()
 		path = _path[1:]
 		path = path.split("?")[0]
 		path = path.split("/") if len(path) > 0 else []
@@ -52,9 +200,12 @@ class HTTPDirective:
 			"content": f"404 GET {_path}".encode("UTF-8")
 		}
 		if res != None: r = res
+		self.record("GET", path, r["status"], start)
 		return r
 	def root_post(self, _path: str, body: bytes) -> HTTPResponse:
+		start = time.perf_counter()
 		path = _path[1:]
+		path = path.split("?")[0]
 		path = path.split("/") if len(path) > 0 else []
 		res = self.get(path, body)
 		r: HTTPResponse = {
@@ -65,8 +216,24 @@ class HTTPDirective:
 			"content": f"404 GET {_path}".encode("UTF-8")
 		}
 		if res != None: r = res
+		self.record("POST", path, r["status"], start)
 		return r
 
+def stage(name: str):
+	# Times one step of handling a request, like loading a history or rendering
+	return metrics.registry.timer("wiki_stage_seconds", stage=name)
+
+def linkExists(target: str) -> bool:
+	page = indexes.linkGraph.resolve(target)
+	return page == None or indexes.livePages.isLive(page)
+
+def linkTag(page: str) -> str:
+	# Identifies which of the pages linked from page exist, since that decides
+	# which links are rendered red
+	targets = indexes.linkGraph.linksFrom(page)
+	if len(targets) == 0: return "0"
+	return "%08x" % zlib.crc32(bytes([indexes.livePages.isLive(t) for t in targets]))
+
 def getWiki(path: str, body: bytes) -> HTTPResponse:
 	if len(path.split(":")) == 1:
 		# A single name...
@@ -82,16 +249,18 @@ def getWiki(path: str, body: bytes) -> HTTPResponse:
 				"content": b""
 			}
 		# Check if this is a page in the default namespace
-		config = utils.read_file("settings.json")
-		assert config != None
+		currentSettings = settingsFile.get()
+		assert currentSettings != None
 		return {
 			"status": 302,
 			"headers": {
-				"Location": "/wiki/" + json.loads(config)["defaultNS"] + (":" + path if len(path) > 0 else "")
+				"Location": "/wiki/" + currentSettings["defaultNS"] + (":" + path if len(path) > 0 else "")
 			},
 			"content": b""
 		}
-	history = wiki.PageHistory.fromFile(path)
+	with locks.pageLock(path).reading():
+		with stage("history_load"):
+			history = wiki.PageHistory.fromFile(path)
 	if history == None:
 		return {
 			"status": 404,
@@ -100,14 +269,49 @@ def getWiki(path: str, body: bytes) -> HTTPResponse:
 			},
 			"content": b""
 		}
-	page: wiki.Page = history.mostRecent()
-	content: str = wikitext.wtToHTML(page.getContent().decode("UTF-8"))
-	return {
-		"status": 200,
-		"headers": {
-			"Content-Type": "text/html"
-		},
-		"content": f"""<!DOCTYPE html>
+	args = urllib.parse.parse_qs(body.decode("UTF-8"))
+	revision = len(history)
+	if "rev" in args:
+		try:
+			revision = int(args["rev"][0])
+		except ValueError:
+			revision = 0
+		if revision < 1 or revision > len(history):
+			return {
+				"status": 404,
+				"headers": {
+					"Content-Type": "text/html"
+				},
+				"content": b""
+			}
+	latest = revision == len(history)
+	# Only the newest revision marks links to missing pages
+	tag = history.ns.getTemplate().tag
+	if latest: tag += "-" + linkTag(history.ns.name + ":" + history.name)
+	etag = f'"{revision}-{history.savedBytes}-{tag}"'
+	if etagMatches(etag): return notModified(etag, "text/html")
+	cached = renderCache.getPage(history.ns.name, history.name, revision, tag)
+	if cached != None:
+		return {
+			"status": 200,
+			"headers": {
+				"Content-Type": "text/html",
+				"ETag": etag
+			},
+			"content": cached
+		}
+	page: wiki.Page = history.mostRecent() if latest else history.getEntry(revision - 1)[1]
+	with stage("template"):
+		source = page.getContent().decode("UTF-8")
+	with stage("wikitext"):
+		content: str = wikitext.wtToHTML(source, linkExists if latest else None)
+	revisionInfo = ""
+	if not latest:
+		revisionInfo = f"""
+			<p>Revision {revision} of {len(history)}</p>
+			<a href=\"/wiki/{page.ns.name}:{page.name}\" class=\"button\">Current version</a>"""
+	with stage("serialize"):
+		rendered = f"""<!DOCTYPE html>
 <html>
 	<head>
 		<link href="/style.css" rel="stylesheet">
@@ -118,10 +322,19 @@ def getWiki(path: str, body: bytes) -> HTTPResponse:
 			<a href=\"/wiki_info/home\" class=\"button\">Wiki info</a>
 			<a href=\"/edit/select/{page.ns.name}:{page.name}\" class=\"button\">Edit page</a>
 			<a href=\"/wiki_history/{page.ns.name}:{page.name}\" class=\"button\">View page history</a>
+			<a href=\"/wiki_info/links/{page.ns.name}:{page.name}\" class=\"button\">What links here</a>{revisionInfo}
 		</div>
 		<div class=\"main-content\">{content}</div>
 	</body>
 </html>""".encode("UTF-8")
+	renderCache.putPage(history.ns.name, history.name, revision, tag, rendered)
+	return {
+		"status": 200,
+		"headers": {
+			"Content-Type": "text/html",
+			"ETag": etag
+		},
+		"content": rendered
 	}
 
 def getWikiHistory(path: str, body: bytes) -> HTTPResponse:
@@ -132,22 +345,44 @@ def getWikiHistory(path: str, body: bytes) -> HTTPResponse:
 			"headers": {},
 			"content": b""
 		}
-	history = wiki.PageHistory.fromFile(path)
+	with locks.pageLock(path).reading():
+		with stage("history_load"):
+			history = wiki.PageHistory.fromFile(path)
 	if history == None:
 		return {
 			"status": 404,
 			"headers": {},
 			"content": b""
 		}
-	rs = ""
-	for entry in history.data:
-		rs += '<hr><p>' + entry[0] + '</p><hr>'
-		w = wikitext.wtToHTML(entry[1].getContent().decode("UTF-8"))
-		rs += w
+	args = urllib.parse.parse_qs(body.decode("UTF-8"))
+	try:
+		offset = max(0, int(args.get("offset", ["0"])[0]))
+		limit = min(500, max(1, int(args.get("limit", ["50"])[0])))
+	except ValueError:
+		return {
+			"status": 400,
+			"headers": {},
+			"content": b""
+		}
+	etag = f'"{len(history)}-{history.savedBytes}"'
+	if etagMatches(etag): return notModified(etag, "text/html")
+	# Newest first; only the revisions on this page are decoded
+	rows: list[str] = []
+	for n in range(len(history) - offset, max(0, len(history) - offset - limit), -1):
+		message, page = history.getEntry(n - 1)
+		fields = ", ".join([f"{name} ({len(value)} bytes)" for name, value in page.fields.items()])
+		if len(page.data) == 0: fields = "no fields"
+		rows.append(f'<p><a href="/wiki/{path}?rev={n}">Revision {n}</a> (<a href="/wiki_diff/{path}?from={n - 1}&to={n}">diff</a>): {message} <span style="color: gray;">{fields}</span></p>')
+	links: list[str] = []
+	if offset > 0:
+		links.append(f'<a class="button" href="/wiki_history/{path}?offset={max(0, offset - limit)}&limit={limit}">Newer</a>')
+	if offset + limit < len(history):
+		links.append(f'<a class="button" href="/wiki_history/{path}?offset={offset + limit}&limit={limit}">Older</a>')
 	return {
 		"status": 200,
 		"headers": {
-			"Content-Type": "text/html"
+			"Content-Type": "text/html",
+			"ETag": etag
 		},
 		"content": f"""<!DOCTYPE html>
 <html>
@@ -160,7 +395,99 @@ def getWikiHistory(path: str, body: bytes) -> HTTPResponse:
 		</div>
 		<div class="main-content">
 			<h3>View history of {path}</h3>
-			{rs}
+			<p>{len(history)} revision(s)</p>
+			{"".join(rows)}
+			<p>{"".join(links)}</p>
+		</div>
+	</body>
+</html>""".encode("UTF-8")
+	}
+
+# Diff lines shown per field, and characters shown per line
+maxDiffLines = 2000
+maxDiffLineLength = 1000
+
+def diffField(kind: str, old: "bytes | memoryview | None", new: "bytes | memoryview | None") -> str:
+	if kind == "file":
+		if old != None and new != None and old == new: return ""
+		describe = lambda v: "absent" if v == None else f"{len(v)} bytes, sha256 {hashlib.sha256(v).hexdigest()}"
+		return f'<pre class="diff"><span class="del">- {describe(old)}</span>\n<span class="ins">+ {describe(new)}</span></pre>'
+	oldLines = bytes(utils.optional(old, b"")).decode("UTF-8", "replace").split("\n")
+	newLines = bytes(utils.optional(new, b"")).decode("UTF-8", "replace").split("\n")
+	out: list[str] = []
+	total = 0
+	for header, ops in diff.hunks(diff.diffLines(oldLines, newLines)):
+		total += len(ops) + 1
+		if len(out) >= maxDiffLines: continue
+		out.append(f'<span class="hunk">{header}</span>')
+		for op, line in ops[:maxDiffLines - len(out)]:
+			if len(line) > maxDiffLineLength: line = line[:maxDiffLineLength] + "..."
+			line = html.escape(op + " " + line)
+			if op == diff.DELETE: line = f'<span class="del">{line}</span>'
+			if op == diff.INSERT: line = f'<span class="ins">{line}</span>'
+			out.append(line)
+	if len(out) == 0: return ""
+	if total > len(out): out.append(f"... {total - len(out)} more line(s) not shown")
+	return '<pre class="diff">' + "\n".join(out) + "</pre>"
+
+def getWikiDiff(path: str, body: bytes) -> HTTPResponse:
+	if len(path.split(":")) == 1:
+		return {
+			"status": 404,
+			"headers": {},
+			"content": b""
+		}
+	with locks.pageLock(path).reading():
+		with stage("history_load"):
+			history = wiki.PageHistory.fromFile(path)
+	if history == None:
+		return {
+			"status": 404,
+			"headers": {},
+			"content": b""
+		}
+	args = urllib.parse.parse_qs(body.decode("UTF-8"))
+	try:
+		to = int(args.get("to", [str(len(history))])[0])
+		start = int(args.get("from", [str(to - 1)])[0])
+	except ValueError:
+		to = 0
+		start = 0
+	if not (0 <= start <= len(history) and 1 <= to <= len(history)):
+		return {
+			"status": 404,
+			"headers": {},
+			"content": b""
+		}
+	etag = f'"{start}-{to}-{history.savedBytes}"'
+	if etagMatches(etag): return notModified(etag, "text/html")
+	# Revision 0 is the empty page before the first revision
+	old = history.getEntry(start - 1)[1].data if start > 0 else {}
+	new = history.getEntry(to - 1)[1].data
+	sections: list[str] = []
+	for name in dict.fromkeys([*history.ns.fields.keys(), *old.keys(), *new.keys()]):
+		changes = diffField(history.ns.fields.get(name, "text"), old.get(name), new.get(name))
+		if changes != "": sections.append(f"<h4>{name}</h4>{changes}")
+	if len(sections) == 0: sections = ["<p>No differences.</p>"]
+	return {
+		"status": 200,
+		"headers": {
+			"Content-Type": "text/html",
+			"ETag": etag
+		},
+		"content": f"""<!DOCTYPE html>
+<html>
+	<head>
+		<link href="/style.css" rel="stylesheet">
+	</head>
+	<body>
+		<div class="sidebar">
+			<a href="/wiki/{path}" class="button">Back to page</a>
+			<a href="/wiki_history/{path}" class="button">View page history</a>
+		</div>
+		<div class="main-content">
+			<h3>Changes to {path} from revision {start} to {to}</h3>
+			{"".join(sections)}
 		</div>
 	</body>
 </html>""".encode("UTF-8")
@@ -174,7 +501,9 @@ def getEditSelect(path: str, body: bytes) -> HTTPResponse:
 			"headers": {},
 			"content": b""
 		}
-	history = wiki.PageHistory.fromFile(path)
+	with locks.pageLock(path).reading():
+		with stage("history_load"):
+			history = wiki.PageHistory.fromFile(path)
 	if history == None:
 		return {
 			"status": 404,
@@ -214,7 +543,9 @@ def getEditContent(path: str, body: bytes) -> HTTPResponse:
 			"headers": {},
 			"content": b""
 		}
-	history = wiki.PageHistory.fromFile(name)
+	with locks.pageLock(name).reading():
+		with stage("history_load"):
+			history = wiki.PageHistory.fromFile(name)
 	if history == None:
 		return {
 			"status": 404,
@@ -277,40 +608,101 @@ def getData(path: str, body: bytes) -> HTTPResponse:
 			"headers": {},
 			"content": b""
 		}
-	history = wiki.PageHistory.fromFile(name)
+	with locks.pageLock(name).reading():
+		with stage("history_load"):
+			history = wiki.PageHistory.fromFile(name)
 	if history == None:
 		return {
 			"status": 404,
 			"headers": {},
 			"content": b""
 		}
+	etag = f'"{len(history)}-{history.savedBytes}"'
+	if etagMatches(etag): return notModified(etag, "text/plain")
 	pageData = history.mostRecent().data
 	return {
 		"status": 200,
 		"headers": {
-			"Content-Type": "text/plain"
+			"Content-Type": "text/plain",
+			"ETag": etag
 		},
-		"content": pageData[contentname] if contentname in pageData.keys() else b""
+		"content": bytes(pageData[contentname]) if contentname in pageData.keys() else b""
+	}
+
+def getInfoLinks(path: str, body: bytes) -> HTTPResponse:
+	if len(path.split(":")) == 1:
+		return {
+			"status": 404,
+			"headers": {},
+			"content": b""
+		}
+	incoming = [f'<p><a href="/wiki/{name}">{name}</a></p>' for name in indexes.linkGraph.linksTo(path)]
+	outgoing = [f'<p><a href="/wiki/{name}">{name}</a></p>' for name in indexes.linkGraph.linksFrom(path)]
+	return {
+		"status": 200,
+		"headers": {
+			"Content-Type": "text/html"
+		},
+		"content": f"""<!DOCTYPE html>
+<html>
+	<head>
+		<link href="/style.css" rel="stylesheet">
+	</head>
+	<body>
+		<div class="sidebar">
+			<a href="/wiki/{path}" class="button">Back to page</a>
+			<a href="/wiki_info/home" class="button">Wiki info</a>
+		</div>
+		<div class="main-content">
+			<h2>What links here: {path}</h2>
+			{"".join(incoming) if len(incoming) > 0 else "<p>No pages link here.</p>"}
+			<h3>Links from {path}</h3>
+			{"".join(outgoing) if len(outgoing) > 0 else "<p>This page has no links.</p>"}
+		</div>
+	</body>
+</html>""".encode("UTF-8")
 	}
 
 def getInfoList(path: str, body: bytes) -> HTTPResponse:
 	title = "List of pages in namespace " + path
 	items: list[str] = []
+	links: list[str] = []
+	form = ""
 	if path == "":
 		# Namespace List
 		title = "Namespace List"
 		items = [
-			f'<p><a href="/wiki_info/list/{name}">{name}</a></p>'
-			for name in os.listdir("pages")
+			f'<p><a href="/wiki_info/list/{name}">{name}</a> ({indexes.pageCatalog.count(name)} pages)</p>'
+			for name in indexes.pageCatalog.listNamespaces()
 		]
 	else:
 		# Page List
-		if os.path.exists("pages/" + path):
+		if path in indexes.pageCatalog.listNamespaces():
+			args = urllib.parse.parse_qs(body.decode("UTF-8"))
+			prefix = args.get("prefix", [""])[0]
+			includeDeleted = args.get("deleted", ["0"])[0] == "1"
+			try:
+				offset = max(0, int(args.get("offset", ["0"])[0]))
+				limit = min(1000, max(1, int(args.get("limit", ["100"])[0])))
+			except ValueError:
+				return {
+					"status": 400,
+					"headers": {},
+					"content": b""
+				}
+			total, pages = indexes.pageCatalog.listPages(path, prefix, offset, limit, includeDeleted)
 			items = [
-				f'<p><a href="/wiki/{path}:{name[:-4]}">{name[:-4]}</a></p>'
-				for name in os.listdir("pages/" + path)
-				if name != "ns.json"
+				f'<tr><td><a href="/wiki/{path}:{info.name}">{info.name}</a></td><td>{"live" if info.live else "deleted"}</td><td>{info.revisions}</td><td>{time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(info.modified))}</td></tr>'
+				for info in pages
 			]
+			items = [f"<p>{total} page(s){f', showing {offset + 1}-{offset + len(pages)}' if len(pages) > 0 else ''}</p>", "<table><tr><th>Page</th><th>Status</th><th>Revisions</th><th>Last modified (UTC)</th></tr>", *items, "</table>"]
+			form = f"""<form action="/wiki_info/list/{path}"><input name="prefix" value="{html.escape(prefix)}" placeholder="Name starts with"> <label><input type="checkbox" name="deleted" value="1"{" checked" if includeDeleted else ""}> Show deleted pages</label> <button>List</button></form>"""
+			query = { "prefix": prefix, "limit": limit }
+			if includeDeleted: query["deleted"] = 1
+			if offset > 0:
+				links.append(f'<a class="button" href="/wiki_info/list/{path}?{urllib.parse.urlencode({**query, "offset": max(0, offset - limit)})}">Previous</a>')
+			if offset + limit < total:
+				links.append(f'<a class="button" href="/wiki_info/list/{path}?{urllib.parse.urlencode({**query, "offset": offset + limit})}">Next</a>')
 		else:
 			items = ["<p>The namespace does not exist!</p>"]
 	return {
@@ -330,22 +722,134 @@ def getInfoList(path: str, body: bytes) -> HTTPResponse:
 		</div>
 		<div class="main-content">
 			<h2>{title}</h2>
+			{form}
+			{"".join(items)}
+			<p>{"".join(links)}</p>
+		</div>
+	</body>
+</html>""".encode("UTF-8")
+	}
+
+def getMetrics(path: str, body: bytes) -> HTTPResponse:
+	# Each server process counts only the requests it handled itself
+	return {
+		"status": 200,
+		"headers": {
+			"Content-Type": "text/plain; version=0.0.4"
+		},
+		"content": metrics.registry.render()
+	}
+
+def getInfoProfiles(path: str, body: bytes) -> HTTPResponse:
+	options = utils.optional(settingsFile.get(), {}).get("profiling", {})
+	if path != "":
+		text = profiling.report(options, path)
+		if text == None:
+			return {
+				"status": 404,
+				"headers": {},
+				"content": b""
+			}
+		title = "Profile " + path
+		items = [f"<pre>{html.escape(text)}</pre>"]
+	else:
+		title = "Profiles"
+		items = [
+			f'<tr><td><a href="/wiki_info/profiles/{c["id"]}">{c["time"]}</a></td><td>{c["reason"]}</td><td>{c["method"]} {html.escape(c["path"])}</td><td>{c["status"]}</td><td>{c["revisions"] if c["revisions"] != None else ""}</td><td>{c["requestBytes"]} / {c["responseBytes"]}</td><td>{c["seconds"] * 1000:.1f}</td></tr>'
+			for c in profiling.listCaptures(options)
+		]
+		if len(items) == 0: items = ["<p>Nothing has been profiled. Set \"profiling\" in settings.json to capture requests.</p>"]
+		else: items = ["<table><tr><th>Time</th><th>Reason</th><th>Request</th><th>Status</th><th>Revisions</th><th>Bytes in / out</th><th>ms</th></tr>", *items, "</table>"]
+	return {
+		"status": 200,
+		"headers": {
+			"Content-Type": "text/html"
+		},
+		"content": f"""<!DOCTYPE html>
+<html>
+	<head>
+		<link href="/style.css" rel="stylesheet">
+	</head>
+	<body>
+		<div class="sidebar">
+			<a href="/wiki/" class="button">Wiki home</a>
+			<a href="/wiki_info/home" class="button">Wiki info</a>
+			<a href="/wiki_info/profiles/" class="button">Profiles</a>
+		</div>
+		<div class="main-content">
+			<h2>{title}</h2>
+			{"".join(items)}
+		</div>
+	</body>
+</html>""".encode("UTF-8")
+	}
+
+def getStyle(path: str, body: bytes) -> HTTPResponse:
+	content = utils.optional(utils.read_file("style.css"), b"")
+	etag = '"%08x"' % zlib.crc32(content)
+	if etagMatches(etag): return notModified(etag, "text/css")
+	return {
+		"status": 200,
+		"headers": {
+			"Content-Type": "text/css",
+			"ETag": etag
+		},
+		"content": content
+	}
+
+def getSearch(path: str, body: bytes) -> HTTPResponse:
+	args = urllib.parse.parse_qs(body.decode("UTF-8"))
+	q = args.get("q", [""])[0]
+	try:
+		offset = max(0, int(args.get("offset", ["0"])[0]))
+		limit = min(100, max(1, int(args.get("limit", ["20"])[0])))
+	except ValueError:
+		return {
+			"status": 400,
+			"headers": {},
+			"content": b""
+		}
+	total, results = indexes.searchIndex.query(q, offset, limit)
+	items = [f'<p><a href="/wiki/{r.page}">{r.page}</a></p>' for r in results]
+	if total == 0 and q != "": items = ["<p>No pages match your search.</p>"]
+	links: list[str] = []
+	if offset > 0:
+		links.append(f'<a class="button" href="/search?{urllib.parse.urlencode({"q": q, "offset": max(0, offset - limit), "limit": limit})}">Previous</a>')
+	if offset + limit < total:
+		links.append(f'<a class="button" href="/search?{urllib.parse.urlencode({"q": q, "offset": offset + limit, "limit": limit})}">Next</a>')
+	return {
+		"status": 200,
+		"headers": {
+			"Content-Type": "text/html"
+		},
+		"content": f"""<!DOCTYPE html>
+<html>
+	<head>
+		<link href="/style.css" rel="stylesheet">
+	</head>
+	<body>
+		<div class="sidebar">
+			<a href="/wiki/" class="button">Wiki home</a>
+			<a href="/wiki_info/home" class="button">Wiki info</a>
+		</div>
+		<div class="main-content">
+			<h2>Search</h2>
+			<form action="/search"><input name="q" value="{html.escape(q)}"> <button>Search</button></form>
+			{f"<p>{total} result(s), showing {offset + 1}-{offset + len(results)}</p>" if len(results) > 0 else ""}
 			{"".join(items)}
+			<p>{"".join(links)}</p>
 		</div>
 	</body>
 </html>""".encode("UTF-8")
 	}
 
 GET = HTTPDirective()
-GET.then("style.css").run(lambda path, body: {
-	"status": 200,
-	"headers": {
-		"Content-Type": "text/css"
-	},
-	"content": utils.optional(utils.read_file("style.css"), b"")
-})
+GET.then("style.css").run(getStyle)
 GET.then("wiki").run(getWiki)
+GET.then("search").run(getSearch)
+GET.then("metrics").run(getMetrics)
 GET.then("wiki_history").run(getWikiHistory)
+GET.then("wiki_diff").run(getWikiDiff)
 GET.then("edit").then("select").run(getEditSelect)
 GET.after("edit").then("content").run(getEditContent)
 GET.after("edit").then("delete").run(lambda path, body: {
@@ -401,11 +905,15 @@ GET.then("wiki_info").then("home").run(lambda path, body: {
 			<h2>Wiki Info</h2>
 			<p><a href="/wiki_info/list/">Namespace List</a></p>
 			<p><a href="/wiki_info/create">Create New Page</a></p>
+			<p><a href="/search">Search</a></p>
+			<p><a href="/wiki_info/profiles/">Profiles</a></p>
 		</div>
 	</body>
 </html>"""
 })
 GET.after("wiki_info").then("list").run(getInfoList)
+GET.after("wiki_info").then("links").run(getInfoLinks)
+GET.after("wiki_info").then("profiles").run(getInfoProfiles)
 GET.after("wiki_info").then("create").run(lambda path, body: {
 	"status": 200,
 	"headers": {
@@ -423,7 +931,7 @@ GET.after("wiki_info").then("create").run(lambda path, body: {
 		</div>
 		<div class="main-content">
 			<h2>Create Page</h2>
-			<p>Namespace: <select id="ns">{"".join(["<option>" + x + "</option>" for x in os.listdir("pages")])}</select></p>
+			<p>Namespace: <select id="ns">{"".join(["<option>" + x + "</option>" for x in indexes.pageCatalog.listNamespaces()])}</select></p>
 			<p>Page Name: <input type="text" id="name"></p>
 			<p>Enter a message for your changes: <input type="text" id="message"></p>
 			<p><button onclick="create()">Create!</button></p>
@@ -459,15 +967,18 @@ def postEdit(path: str, body: bytes) -> HTTPResponse:
 			"headers": {},
 			"content": b""
 		}
-	history = wiki.PageHistory.fromFile(name)
-	if history == None:
-		return {
-			"status": 404,
-			"headers": {},
-			"content": b""
-		}
-	history.appendEdit(message, contentname, newcontent)
-	history.save()
+	with locks.pageLock(name).writing():
+		history = wiki.PageHistory.fromFile(name)
+		if history == None:
+			return {
+				"status": 404,
+				"headers": {},
+				"content": b""
+			}
+		history.appendEdit(message, contentname, newcontent)
+		with stage("history_save"):
+			history.save()
+		pageChanged(history)
 	return {
 		"status": 200,
 		"headers": {},
@@ -487,7 +998,10 @@ def postCreate(path: str, body: bytes) -> HTTPResponse:
 	page = wiki.PageHistory(ns, pagename, [
 		(message, wiki.Page(ns, pagename, {}))
 	])
-	page.save()
+	with locks.pageLock(ns.name + ":" + pagename).writing():
+		with stage("history_save"):
+			page.save()
+		pageChanged(page)
 	return {
 		"status": 200,
 		"headers": {},
@@ -503,15 +1017,29 @@ def postDelete(path: str, body: bytes) -> HTTPResponse:
 			"headers": {},
 			"content": b""
 		}
-	history = wiki.PageHistory.fromFile(path)
-	if history == None:
-		return {
-			"status": 404,
-			"headers": {},
-			"content": b""
-		}
-	history.appendDelete(message)
-	history.save()
+	with locks.pageLock(path).writing():
+		history = wiki.PageHistory.fromFile(path)
+		if history == None:
+			return {
+				"status": 404,
+				"headers": {},
+				"content": b""
+			}
+		history.appendDelete(message)
+		with stage("history_save"):
+			history.save()
+		pageChanged(history)
+	return {
+		"status": 200,
+		"headers": {},
+		"content": b""
+	}
+
+def postReload(path: str, body: bytes) -> HTTPResponse:
+	# Re-read settings.json and every ns.json now instead of waiting for the next check
+	config.reloadAll()
+	renderCache.clear()
+	if changeLog != None: changeLog.record("*")
 	return {
 		"status": 200,
 		"headers": {},
@@ -522,27 +1050,110 @@ POST = HTTPDirective()
 POST.then("edit").run(postEdit)
 POST.then("create").run(postCreate)
 POST.then("delete").run(postDelete)
+POST.then("reload").run(postReload)
+
+def handleRequest(method: str, path: str, body: bytes) -> HTTPResponse:
+	run = lambda: GET.root_get(path) if method == "GET" else POST.root_post(path, body)
+	options = utils.optional(settingsFile.get(), {}).get("profiling")
+	if options == None: return run()
+	why = profiling.reason(options, path)
+	if why == None: return run()
+	start = time.perf_counter()
+	res, profiler = profiling.profile(run)
+	seconds = time.perf_counter() - start
+	if profiler == None or (why == "slow" and seconds < options["slowSeconds"]): return res
+	page = None
+	revisions = None
+	parts = path.split("?")[0].split("/")
+	if len(parts) > 2 and ":" in parts[2]:
+		page = urllib.parse.unquote(parts[2])
+		info = indexes.pageCatalog.info.get(page.split(":", 1)[0], {}).get(page.split(":", 1)[1])
+		if info != None: revisions = info.revisions
+	profiling.save(options, profiler, {
+		"time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+		"reason": why,
+		"method": method,
+		"path": profiling.redact(path),
+		"route": parts[1] if len(parts) > 1 else "",
+		"page": page,
+		"revisions": revisions,
+		"status": res["status"],
+		"requestBytes": len(body),
+		"responseBytes": len(res["content"]),
+		"seconds": seconds
+	})
+	return res
 
 class MyServer(BaseHTTPRequestHandler):
+	# Keep connections open between requests; while waiting for the next one
+	# they are handed back to the server instead of holding a worker
+	protocol_version = "HTTP/1.1"
+	timeout = 15
+	parked = False
+	def handle(self):
+		self.parked = False
+		self.close_connection = True
+		self.handle_one_request()
+		while not self.close_connection:
+			# Requests the client already sent are served right away
+			try:
+				self.connection.settimeout(0)
+				waiting = len(self.rfile.peek(1)) > 0
+				self.connection.settimeout(self.timeout)
+			except OSError:
+				return
+			if not waiting:
+				self.parked = True
+				return
+			self.handle_one_request()
+	def finish(self):
+		if not self.parked: super().finish()
+	def resume(self):
+		try:
+			self.handle()
+		finally:
+			self.finish()
+	# Headers and body are written separately; without this the body waits for
+	# the client's delayed ACK on kept-alive connections
+	disable_nagle_algorithm = True
 	def do_GET(self):
-		global running
-		res = GET.root_get(self.path)
-		self.send_response(res["status"])
-		for h in res["headers"]:
-			self.send_header(h, res["headers"][h])
-		self.end_headers()
+		self.started = time.perf_counter()
+		syncChanges()
+		request.headers = self.headers
+		res = handleRequest("GET", self.path, b"")
+		self.sendResponse(res)
+	def do_POST(self):
+		self.started = time.perf_counter()
+		syncChanges()
+		request.headers = self.headers
+		res = handleRequest("POST", self.path, self.rfile.read(int(self.headers["Content-Length"])))
+		self.sendResponse(res)
+	def sendResponse(self, res: HTTPResponse):
+		if res["status"] == 200:
+			with stage("compress"):
+				res = compressResponse(self.path, res)
 		c = res["content"]
 		if isinstance(c, str): c = c.encode("utf-8")
-		self.wfile.write(c)
-	def do_POST(self):
-		res = POST.root_post(self.path, self.rfile.read(int(self.headers["Content-Length"])))
 		self.send_response(res["status"])
 		for h in res["headers"]:
 			self.send_header(h, res["headers"][h])
+		if res["status"] != 304:
+			self.send_header("Content-Length", str(len(c)))
 		self.end_headers()
-		c = res["content"]
-		if isinstance(c, str): c = c.encode("utf-8")
-		self.wfile.write(c)
+		if res["status"] != 304:
+			self.wfile.write(c)
+		if accessLog != None:
+			line = json.dumps({
+				"time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+				"client": self.client_address[0],
+				"method": self.command,
+				"path": profiling.redact(self.path),
+				"status": res["status"],
+				"bytes": len(c) if res["status"] != 304 else 0,
+				"seconds": round(time.perf_counter() - self.started, 6)
+			})
+			with accessLogLock:
+				accessLog.write(line + "\n")
 	def log_message(self, format: str, *args: typing.Any) -> None:
 		return;
 		if 400 <= int(args[1]) < 500:
@@ -552,15 +1163,113 @@ class MyServer(BaseHTTPRequestHandler):
 		print(u"\u001b[0m", end="")
 		# don't output requests
 
+class PooledHTTPServer(HTTPServer):
+	# Like socketserver.ThreadingMixIn, but with a fixed number of worker threads
+	request_queue_size = 128
+	# Kept-alive connections wait for their next request in a selector, and are
+	# closed after idleSeconds or when more than maxIdle are waiting
+	idleSeconds = 15
+	maxIdle = 1024
+	def __init__(self, address: tuple[str, int], handler: "type[BaseHTTPRequestHandler]", workers: int):
+		super().__init__(address, handler)
+		self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+		self.idleLock = threading.Lock()
+		self.idle: selectors.BaseSelector | None = None
+	def serve_forever(self, poll_interval: float = 0.5):
+		# Made here so every forked process has its own
+		self.idle = selectors.DefaultSelector()
+		threading.Thread(target=self.watchIdle, args=(self.idle,), daemon=True).start()
+		super().serve_forever(poll_interval)
+	def process_request(self, request: typing.Any, client_address: typing.Any):
+		self.pool.submit(self.process_request_thread, request, client_address)
+	def process_request_thread(self, request: typing.Any, client_address: typing.Any, handler: MyServer | None = None):
+		try:
+			if handler == None:
+				handler = typing.cast(MyServer, self.RequestHandlerClass(request, client_address, self))
+			else:
+				handler.resume()
+			if handler.parked and self.park(handler): return
+		except Exception:
+			self.handle_error(request, client_address)
+		self.shutdown_request(request)
+	def park(self, handler: MyServer) -> bool:
+		with self.idleLock:
+			if self.idle == None or len(self.idle.get_map()) >= self.maxIdle: return False
+			self.idle.register(handler.connection, selectors.EVENT_READ, (handler, time.monotonic()))
+			return True
+	def closeIdle(self, handler: MyServer):
+		handler.parked = False
+		try:
+			handler.finish()
+		except OSError:
+			pass
+		self.shutdown_request(handler.request)
+	def watchIdle(self, idle: selectors.BaseSelector):
+		while True:
+			try:
+				events = idle.select(0.5)
+			except (OSError, ValueError):
+				# Closed by server_close
+				return
+			now = time.monotonic()
+			with self.idleLock:
+				if self.idle != idle: return
+				ready = [key.data[0] for key, _ in events]
+				expired = [key.data[0] for key in idle.get_map().values() if key.data[0] not in ready and now - key.data[1] > self.idleSeconds]
+				for handler in ready + expired: idle.unregister(handler.connection)
+			for handler in ready: self.pool.submit(self.process_request_thread, handler.request, handler.client_address, handler)
+			for handler in expired: self.closeIdle(handler)
+	def server_close(self):
+		super().server_close()
+		with self.idleLock:
+			idle = self.idle
+			self.idle = None
+		if idle != None:
+			for key in [*idle.get_map().values()]: self.closeIdle(key.data[0])
+			idle.close()
+		self.pool.shutdown(wait=True)
+
+def serveForked(webServer: PooledHTTPServer, processes: int):
+	# Every child accepts connections from the same listening socket
+	children: list[int] = []
+	for _ in range(processes):
+		pid = os.fork()
+		if pid == 0:
+			signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+			try:
+				webServer.serve_forever()
+			except (KeyboardInterrupt, SystemExit):
+				pass
+			finally:
+				webServer.server_close()
+				os._exit(0)
+		children.append(pid)
+	signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+	try:
+		for pid in children: os.waitpid(pid, 0)
+	except (KeyboardInterrupt, SystemExit):
+		for pid in children:
+			try:
+				os.kill(pid, signal.SIGTERM)
+			except ProcessLookupError:
+				pass
+		for pid in children:
+			try:
+				os.waitpid(pid, 0)
+			except ChildProcessError:
+				pass
+
 if __name__ == "__main__":
-	running = True
-	webServer = HTTPServer((hostName, serverPort), MyServer)
-	webServer.timeout = 1
+	for index in indexes.pageIndexes: index.load()
+	webServer = PooledHTTPServer((hostName, serverPort), MyServer, workers)
 	print("Server started http://%s:%s" % (hostName, serverPort))
-	while running:
+	if processes > 1:
+		changeLog = cache.ChangeLog("pages/.changes")
+		serveForked(webServer, processes)
+	else:
 		try:
-			webServer.handle_request()
+			webServer.serve_forever()
 		except KeyboardInterrupt:
-			running = False
+			pass
 	webServer.server_close()
 	print("Server stopped")
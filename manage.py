@@ -0,0 +1,272 @@
+import argparse
+import blobs
+import collections
+import concurrent.futures
+import gzip
+import hashlib
+import indexes
+import json
+import locks
+import os
+import sys
+import typing
+import utils
+import wiki
+
+def listPages() -> list[str]:
+	names: list[str] = []
+	for ns in wiki.listNamespaces():
+		for filename in sorted(os.listdir(f"pages/{ns}")):
+			if filename.endswith(".dat"):
+				names.append(ns + ":" + filename[:-4])
+	return names
+
+def migrate(args: argparse.Namespace):
+	upgraded = 0
+	for name in listPages():
+		with locks.pageLock(name).writing():
+			history = wiki.PageHistory.fromFile(name)
+			if history == None or history.version == wiki.HISTORY_VERSION: continue
+			print(f"{name}: version {history.version} -> {wiki.HISTORY_VERSION} ({len(history)} revisions)")
+			if not args.dry_run: history.rewrite()
+			upgraded += 1
+	print(f"{upgraded} page(s) {'would be' if args.dry_run else 'were'} upgraded")
+
+def dedupe(args: argparse.Namespace):
+	# Rewrite every history that still stores all values inline
+	converted = 0
+	before = 0
+	after = 0
+	for name in listPages():
+		with locks.pageLock(name).writing():
+			history = wiki.PageHistory.fromFile(name)
+			if history == None or history.version == wiki.HISTORY_VERSION and history.flags & wiki.FLAG_BLOBS: continue
+			size = history.savedBytes
+			if args.dry_run:
+				print(f"{name}: {size} bytes")
+			else:
+				history.rewrite(history.flags | wiki.FLAG_BLOBS)
+				print(f"{name}: {size} -> {history.savedBytes} bytes")
+			before += size
+			after += history.savedBytes
+			converted += 1
+	print(f"{converted} page(s) {'would be' if args.dry_run else 'were'} converted" + ("" if args.dry_run else f", {before} -> {after} bytes"))
+
+def compact(args: argparse.Namespace):
+	# Rewrite histories as snapshots and deltas, checking every revision
+	# against the original before moving on
+	if args.max_chain != None: wiki.maxDeltaChain = args.max_chain
+	converted = 0
+	before = 0
+	after = 0
+	for name in listPages():
+		with locks.pageLock(name).writing():
+			history = wiki.PageHistory.fromFile(name)
+			if history == None or len(history) == 0: continue
+			if not args.force and history.version == wiki.HISTORY_VERSION and history.flags & wiki.FLAG_DELTAS: continue
+			size = history.savedBytes
+			before += size
+			converted += 1
+			if args.dry_run:
+				print(f"{name}: {size} bytes, {len(history)} revisions")
+				after += size
+				continue
+			original = bytes(history.view[:history.savedBytes])
+			expected = [(message, { k: bytes(v) for k, v in page.data.items() }) for message, page in history.data]
+			# Older files have no flags yet, so they get the configured ones
+			flags = history.flags if history.version == wiki.HISTORY_VERSION else wiki.historyFlags
+			history.rewrite(flags | wiki.FLAG_DELTAS)
+			compacted = wiki.PageHistory.fromFile(name)
+			if compacted == None or [(m, p.data) for m, p in compacted.data] != expected:
+				utils.write_file_atomic(history.getFilename(), original)
+				os.remove(history.getIndexFilename())
+				raise SystemExit(f"{name}: the compacted history does not match the original; it was left as it was")
+			print(f"{name}: {size} -> {history.savedBytes} bytes")
+			after += history.savedBytes
+	print(f"{converted} page(s) {'would be' if args.dry_run else 'were'} compacted" + ("" if args.dry_run else f", {before} -> {after} bytes"))
+
+def collectBlobs(args: argparse.Namespace):
+	freed, freedBytes = indexes.blobReferences.collect(args.grace, args.dry_run)
+	print(f"{freed} unreferenced blob(s) ({freedBytes} bytes) {'would be' if args.dry_run else 'were'} deleted")
+
+def clearIndexes():
+	for index in indexes.pageIndexes:
+		for filename in (index.snapshotFilename, index.logFilename):
+			if os.path.exists(filename): os.remove(filename)
+
+def reindex(args: argparse.Namespace):
+	clearIndexes()
+	for index in indexes.pageIndexes: index.load()
+	print(f"Indexed {len(indexes.searchIndex.sizes)} page(s): {len(indexes.searchIndex.postings)} distinct term(s), {len(indexes.linkGraph.incoming)} link target(s)")
+
+# A dump is DUMP_MAGIC followed by records: a kind byte, the name and the data,
+# each prefixed with a varint length. Namespaces ("N", the ns.json file) come
+# before their pages ("P", the page's history in the current file format), and
+# an "E" record with no name or data ends the dump. Histories may refer to
+# blobs, which are each written once ("B", named by the hex digest) before the
+# first page that needs them.
+DUMP_MAGIC = b"WIKIDUMP\x01"
+
+def openDump(filename: str, mode: str) -> typing.BinaryIO:
+	if filename.endswith(".gz"): return typing.cast(typing.BinaryIO, gzip.open(filename, mode + "b", 6))
+	return open(filename, mode + "b")
+
+def writeRecord(f: typing.BinaryIO, kind: bytes, name: str, data: bytes):
+	header = bytearray(kind)
+	encodedName = name.encode("UTF-8")
+	wiki.writeVarint(header, len(encodedName))
+	header += encodedName
+	wiki.writeVarint(header, len(data))
+	f.write(header)
+	f.write(data)
+
+def readVarint(f: typing.BinaryIO) -> int:
+	n = 0
+	shift = 0
+	while True:
+		byte = f.read(1)
+		if len(byte) == 0: raise EOFError()
+		n |= (byte[0] & 0x7F) << shift
+		if byte[0] < 0x80: return n
+		shift += 7
+
+def readRecord(f: typing.BinaryIO) -> tuple[bytes, str, bytes]:
+	kind = f.read(1)
+	if len(kind) == 0: raise EOFError()
+	name = f.read(readVarint(f))
+	length = readVarint(f)
+	data = f.read(length)
+	if len(data) != length: raise EOFError()
+	return (kind, name.decode("UTF-8"), data)
+
+def validName(name: str) -> bool:
+	# Names from a dump become paths under pages/
+	return name != "" and not name.startswith(".") and "/" not in name and "\\" not in name and "\0" not in name
+
+def exportPage(name: str) -> tuple[str, bytes, list[bytes]]:
+	with locks.pageLock(name).reading():
+		history = wiki.PageHistory.fromFile(name)
+		if history == None: raise ValueError(f"{name}: namespace is missing")
+		# Decoding and encoding again drops anything damaged and upgrades old files;
+		# values in the blob store stay references, the blobs go in their own records
+		data = wiki.historyHeader(wiki.FLAG_BLOBS) + b"".join([wiki.PageHistory.entryToBytes(*i, wiki.FLAG_BLOBS) for i in history.data])
+		return (name, data, [*history.blobReferences().keys()])
+
+def importPage(name: str, data: bytes) -> int:
+	nsName, pageName = name.split(":", 1)
+	ns = wiki.Namespace.fromFile(nsName)
+	if ns == None: raise ValueError(f"{name}: namespace is missing")
+	if data[:len(wiki.HISTORY_MAGIC) + 1] != wiki.HISTORY_MAGIC + bytes([wiki.HISTORY_VERSION]): raise ValueError(f"{name}: unsupported history format")
+	flags = data[len(wiki.HISTORY_MAGIC) + 1]
+	if flags & ~wiki.FLAG_BLOBS: raise ValueError(f"{name}: unsupported history flags {flags}")
+	view = memoryview(data)
+	starts, end, status = wiki.PageHistory.scan(view, len(wiki.HISTORY_HEADER), wiki.HISTORY_VERSION)
+	if status != "complete": raise ValueError(f"{name}: history is damaged at byte {end}")
+	history = wiki.PageHistory(ns, pageName, [wiki.PageHistory.readOneEntry(ns, pageName, wiki.Buffer(view[start:]), wiki.HISTORY_VERSION, flags) for start in starts])
+	for _, page in history.pending:
+		for value in page.fields.values():
+			if isinstance(value, blobs.Reference) and not os.path.exists(blobs.getFilename(value.digest)):
+				raise ValueError(f"{name}: blob {value.digest.hex()} is not in the dump")
+	with locks.pageLock(name).writing():
+		history.save()
+	return len(history)
+
+def runParallel(jobs: int, tasks: typing.Iterator[tuple[typing.Callable[..., typing.Any], tuple[typing.Any, ...]]], done: typing.Callable[[typing.Any], None]):
+	# Runs tasks on a process pool, handing results to done in order; only a few
+	# tasks per worker are in flight so memory stays bounded
+	with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+		inFlight: "collections.deque[concurrent.futures.Future[typing.Any]]" = collections.deque()
+		for func, taskArgs in tasks:
+			inFlight.append(pool.submit(func, *taskArgs))
+			if len(inFlight) >= jobs * 4: done(inFlight.popleft().result())
+		while len(inFlight) > 0:
+			done(inFlight.popleft().result())
+
+def export(args: argparse.Namespace):
+	pages = listPages()
+	# Only values that are already in the blob store are written as references
+	wiki.blobMinBytes = sys.maxsize
+	written: set[bytes] = set()
+	with openDump(args.file, "w") as f:
+		f.write(DUMP_MAGIC)
+		for ns in wiki.listNamespaces():
+			writeRecord(f, b"N", ns, utils.optional(utils.read_file(f"pages/{ns}/ns.json"), b""))
+		def done(result: tuple[str, bytes, list[bytes]]):
+			name, data, digests = result
+			for digest in digests:
+				if digest in written: continue
+				blob = utils.read_file(blobs.getFilename(digest))
+				if blob == None: raise SystemExit(f"{name}: blob {digest.hex()} is missing")
+				writeRecord(f, b"B", digest.hex(), blob)
+				written.add(digest)
+			writeRecord(f, b"P", name, data)
+		runParallel(args.jobs, ((exportPage, (name,)) for name in pages), done)
+		writeRecord(f, b"E", "", b"")
+	print(f"Exported {len(pages)} page(s) and {len(written)} blob(s) to {args.file}")
+
+def importDump(args: argparse.Namespace):
+	pages = 0
+	revisions = 0
+	with openDump(args.file, "r") as f:
+		if f.read(len(DUMP_MAGIC)) != DUMP_MAGIC: raise SystemExit(f"{args.file} is not a wiki dump")
+		def records() -> typing.Iterator[tuple[typing.Callable[..., typing.Any], tuple[typing.Any, ...]]]:
+			while True:
+				try:
+					kind, name, data = readRecord(f)
+				except EOFError:
+					raise SystemExit(f"{args.file} ends early; it was cut off")
+				if kind == b"E": return
+				if kind == b"N":
+					if not validName(name) or ":" in name: raise SystemExit(f"Bad namespace name in dump: {name!r}")
+					os.makedirs(f"pages/{name}", exist_ok=True)
+					utils.write_file_atomic(f"pages/{name}/ns.json", data)
+				elif kind == b"B":
+					if hashlib.sha256(data).hexdigest() != name: raise SystemExit(f"Blob {name!r} in dump does not match its digest")
+					blobs.write(data)
+				elif kind == b"P":
+					if ":" not in name or not all([validName(part) for part in name.split(":", 1)]): raise SystemExit(f"Bad page name in dump: {name!r}")
+					yield (importPage, (name, data))
+				else:
+					raise SystemExit(f"Unknown record in dump: {kind!r}")
+		def done(result: int):
+			nonlocal pages, revisions
+			pages += 1
+			revisions += result
+		runParallel(args.jobs, records(), done)
+	# The indexes are rebuilt the next time the server starts
+	clearIndexes()
+	print(f"Imported {pages} page(s) with {revisions} revision(s) from {args.file}")
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Maintenance commands for the wiki's pages/ directory")
+	commands = parser.add_subparsers(required=True)
+	p = commands.add_parser("migrate", help="Rewrite old history files in the current format")
+	p.add_argument("--dry-run", action="store_true", help="Only list the files that would be upgraded")
+	p.set_defaults(func=migrate)
+	p = commands.add_parser("reindex", help="Rebuild the search index and link graph from scratch")
+	p.set_defaults(func=reindex)
+	p = commands.add_parser("dedupe", help="Move large field values of existing histories to the blob store")
+	p.add_argument("--dry-run", action="store_true", help="Only list the files that would be converted")
+	p.set_defaults(func=dedupe)
+	p = commands.add_parser("compact", help="Store histories as periodic snapshots with line deltas between them")
+	p.add_argument("--max-chain", type=int, help=f"Most deltas between two snapshots, {wiki.maxDeltaChain} by default")
+	p.add_argument("--force", action="store_true", help="Also rewrite histories that already use deltas")
+	p.add_argument("--dry-run", action="store_true", help="Only list the files that would be compacted")
+	p.set_defaults(func=compact)
+	p = commands.add_parser("gc", help="Delete blobs that no revision references")
+	p.add_argument("--grace", type=float, default=3600, help="Keep blobs written or reused this many seconds ago")
+	p.add_argument("--dry-run", action="store_true", help="Only count what would be deleted")
+	p.set_defaults(func=collectBlobs)
+	p = commands.add_parser("export", help="Write every namespace and page history to one dump file")
+	p.add_argument("file", help="Dump to write; compressed if it ends in .gz")
+	p.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="Number of worker processes")
+	p.set_defaults(func=export)
+	p = commands.add_parser("import", help="Load a dump written by export, replacing pages with the same names")
+	p.add_argument("file", help="Dump to read; compressed if it ends in .gz")
+	p.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="Number of worker processes")
+	p.set_defaults(func=importDump)
+	args = parser.parse_args()
+	raw = utils.read_file("settings.json")
+	# Rewritten histories use the same storage settings as the server
+	wiki.configureStorage({} if raw == None else json.loads(raw))
+	args.func(args)
@@ -0,0 +1,92 @@
+import contextlib
+import threading
+import time
+import typing
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+Labels = tuple[tuple[str, str], ...]
+
+class Histogram:
+	def __init__(self):
+		self.counts = [0] * (len(BUCKETS) + 1)
+		self.sum = 0.0
+		self.count = 0
+	def observe(self, seconds: float):
+		i = 0
+		while i < len(BUCKETS) and seconds > BUCKETS[i]: i += 1
+		self.counts[i] += 1
+		self.sum += seconds
+		self.count += 1
+
+class Registry:
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.help: dict[str, tuple[str, str]] = {}
+		self.counters: "dict[str, dict[Labels, float]]" = {}
+		self.histograms: "dict[str, dict[Labels, Histogram]]" = {}
+		# Values read when the metrics are rendered, like cache statistics
+		self.collectors: "list[typing.Callable[[], list[tuple[str, dict[str, str], float]]]]" = []
+	def describe(self, name: str, kind: str, text: str):
+		self.help[name] = (kind, text)
+	def increment(self, name: str, labels: dict[str, str], amount: float = 1):
+		key = tuple(sorted(labels.items()))
+		with self.lock:
+			values = self.counters.setdefault(name, {})
+			values[key] = values.get(key, 0) + amount
+	def observe(self, name: str, labels: dict[str, str], seconds: float):
+		key = tuple(sorted(labels.items()))
+		with self.lock:
+			histograms = self.histograms.setdefault(name, {})
+			if key not in histograms: histograms[key] = Histogram()
+			histograms[key].observe(seconds)
+	@contextlib.contextmanager
+	def timer(self, name: str, **labels: str):
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.observe(name, labels, time.perf_counter() - start)
+	def collect(self, collector: "typing.Callable[[], list[tuple[str, dict[str, str], float]]]"):
+		self.collectors.append(collector)
+	def render(self) -> bytes:
+		# Prometheus text exposition format
+		lines: list[str] = []
+		def header(name: str, kind: str):
+			text = self.help.get(name, (kind, ""))[1]
+			if text != "": lines.append(f"# HELP {name} {text}")
+			lines.append(f"# TYPE {name} {self.help.get(name, (kind, ''))[0]}")
+		collected: "dict[str, dict[Labels, float]]" = {}
+		for collector in self.collectors:
+			for name, labels, value in collector():
+				collected.setdefault(name, {})[tuple(sorted(labels.items()))] = value
+		with self.lock:
+			for name, values in [*self.counters.items(), *collected.items()]:
+				header(name, "counter")
+				for key, value in sorted(values.items()):
+					lines.append(f"{name}{formatLabels(key)} {formatValue(value)}")
+			for name, histograms in self.histograms.items():
+				header(name, "histogram")
+				for key, histogram in sorted(histograms.items()):
+					cumulative = 0
+					for bound, count in zip([*BUCKETS, float("inf")], histogram.counts):
+						cumulative += count
+						lines.append(f"{name}_bucket{formatLabels(key + (('le', formatValue(bound)),))} {cumulative}")
+					lines.append(f"{name}_sum{formatLabels(key)} {formatValue(histogram.sum)}")
+					lines.append(f"{name}_count{formatLabels(key)} {histogram.count}")
+		return ("\n".join(lines) + "\n").encode("UTF-8")
+
+def formatLabels(labels: Labels) -> str:
+	if len(labels) == 0: return ""
+	return "{" + ",".join([f'{k}="{escapeLabel(v)}"' for k, v in labels]) + "}"
+
+def escapeLabel(value: str) -> str:
+	return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def formatValue(value: float) -> str:
+	if value == float("inf"): return "+Inf"
+	if value == int(value): return str(int(value))
+	return repr(value)
+
+registry = Registry()
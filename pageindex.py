@@ -0,0 +1,103 @@
+import abc
+import json
+import os
+import sys
+import threading
+import typing
+import locks
+import utils
+import wiki
+
+def readHistory(page: str) -> "wiki.PageHistory | None":
+	with locks.pageLock(page).reading():
+		try:
+			return wiki.PageHistory.fromFile(page)
+		except ValueError as e:
+			print(f"Not indexing {page}: {e}", file=sys.stderr)
+
+class PageIndex(abc.ABC):
+	# Something derived from the newest revision of every page. It is kept on disk
+	# as a snapshot plus a log of later updates, both made of JSON lines like
+	# {"page": "NS:Page", "size": <.dat size>, "value": ...}; the size tells
+	# which pages changed since they were last indexed.
+	def __init__(self, filename: str):
+		self.snapshotFilename = filename + ".snapshot"
+		self.logFilename = filename + ".log"
+		self.lock = threading.RLock()
+		self.loaded = False
+		self.sizes: "dict[str, int]" = {}
+	@abc.abstractmethod
+	def extract(self, history: wiki.PageHistory) -> typing.Any: ...
+	@abc.abstractmethod
+	def apply(self, page: str, value: typing.Any):
+		# Replace what is stored for page; value is None when the page is gone
+		...
+	@abc.abstractmethod
+	def snapshotValue(self, page: str) -> typing.Any: ...
+	def setDoc(self, page: str, size: int, value: typing.Any):
+		self.sizes[page] = size
+		self.apply(page, value)
+	def removeDoc(self, page: str):
+		self.sizes.pop(page, None)
+		self.apply(page, None)
+	def readRecords(self, filename: str):
+		f = None
+		try:
+			f = open(filename, "rb")
+		except FileNotFoundError:
+			return
+		for line in f:
+			try:
+				record = json.loads(line)
+			except ValueError:
+				# The last line of the log might have been cut off
+				break
+			self.readRecord(record)
+		f.close()
+	def readRecord(self, record: dict[str, typing.Any]):
+		self.setDoc(record["page"], record["size"], record["value"])
+	def writeLog(self, record: dict[str, typing.Any]):
+		fd = os.open(self.logFilename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+		try:
+			os.write(fd, json.dumps(record).encode("UTF-8") + b"\n")
+		finally:
+			os.close(fd)
+	def load(self):
+		with self.lock:
+			if self.loaded: return
+			self.readRecords(self.snapshotFilename)
+			self.readRecords(self.logFilename)
+			self.loaded = True
+		if self.refreshStale() > 0 or os.path.exists(self.logFilename):
+			self.writeSnapshot()
+	def writeSnapshot(self):
+		with self.lock:
+			lines: list[bytes] = []
+			for page, size in self.sizes.items():
+				lines.append(json.dumps({ "page": page, "size": size, "value": self.snapshotValue(page) }).encode("UTF-8") + b"\n")
+			utils.write_file_atomic(self.snapshotFilename, b"".join(lines))
+			if os.path.exists(self.logFilename): os.remove(self.logFilename)
+	def refreshStale(self) -> int:
+		# Index every page whose history file changed since it was last indexed
+		sizes: dict[str, int] = {}
+		for ns in wiki.listNamespaces():
+			for filename in os.listdir(f"pages/{ns}"):
+				if filename.endswith(".dat"):
+					sizes[ns + ":" + filename[:-4]] = os.path.getsize(f"pages/{ns}/{filename}")
+		with self.lock:
+			stale = [page for page, size in sizes.items() if self.sizes.get(page) != size]
+			removed = [page for page in self.sizes.keys() if page not in sizes]
+			for page in removed: self.removeDoc(page)
+		# Page locks are taken before self.lock everywhere, so don't hold it here
+		for page in stale: self.refresh(page, False)
+		return len(stale) + len(removed)
+	def refresh(self, page: str, persist: bool = True):
+		history = readHistory(page)
+		if history != None: self.update(history, persist)
+	def update(self, history: wiki.PageHistory, persist: bool = True):
+		value = self.extract(history)
+		page = history.ns.name + ":" + history.name
+		with self.lock:
+			if not self.loaded: return
+			self.setDoc(page, history.savedBytes, value)
+			if persist: self.writeLog({ "page": page, "size": history.savedBytes, "value": value })
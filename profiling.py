@@ -0,0 +1,87 @@
+import cProfile
+import io
+import itertools
+import json
+import os
+import pstats
+import random
+import time
+import typing
+import urllib.parse
+import utils
+
+T = typing.TypeVar("T")
+
+# Settings (the "profiling" object in settings.json):
+#   directory    where captures are written, "profiles" by default
+#   adminToken   requests with ?profile=<adminToken> are always profiled
+#   sampleRate   share of all requests to profile, 0 by default
+#   slowSeconds  profile every request and keep those that took longer
+#   maxCaptures  older captures are deleted past this many, 100 by default
+counter = itertools.count()
+
+def reason(options: dict[str, typing.Any], path: str) -> str | None:
+	# Why this request should be profiled, if at all
+	token = options.get("adminToken")
+	if token != None and "?" in path:
+		query = urllib.parse.parse_qs(path.split("?", 1)[1])
+		if token in query.get("profile", []): return "requested"
+	if random.random() < options.get("sampleRate", 0): return "sampled"
+	if options.get("slowSeconds") != None: return "slow"
+	return None
+
+def redact(path: str) -> str:
+	# The path without the profile parameter, which holds the admin token
+	if "?" not in path: return path
+	base, query = path.split("?", 1)
+	kept = [(k, v) for k, v in urllib.parse.parse_qsl(query, keep_blank_values=True) if k != "profile"]
+	return base + ("?" + urllib.parse.urlencode(kept) if len(kept) > 0 else "")
+
+def profile(func: typing.Callable[[], T]) -> tuple[T, cProfile.Profile | None]:
+	profiler = cProfile.Profile()
+	try:
+		profiler.enable()
+	except ValueError:
+		# Another request in this process is already being profiled
+		return (func(), None)
+	try:
+		result = func()
+	finally:
+		profiler.disable()
+	return (result, profiler)
+
+def save(options: dict[str, typing.Any], profiler: cProfile.Profile, info: dict[str, typing.Any]):
+	directory = options.get("directory", "profiles")
+	os.makedirs(directory, exist_ok=True)
+	name = f"{int(time.time() * 1000)}-{os.getpid()}-{next(counter)}"
+	profiler.dump_stats(f"{directory}/{name}.prof")
+	# The description is written last; captures without one are ignored
+	utils.write_file_atomic(f"{directory}/{name}.json", json.dumps({ **info, "id": name }).encode("UTF-8"))
+	captures = sorted([f[:-5] for f in os.listdir(directory) if f.endswith(".json")])
+	for old in captures[:max(0, len(captures) - options.get("maxCaptures", 100))]:
+		for extension in (".json", ".prof"):
+			try:
+				os.remove(f"{directory}/{old}{extension}")
+			except FileNotFoundError:
+				pass
+
+def listCaptures(options: dict[str, typing.Any]) -> list[dict[str, typing.Any]]:
+	directory = options.get("directory", "profiles")
+	if not os.path.isdir(directory): return []
+	captures: list[dict[str, typing.Any]] = []
+	for filename in sorted(os.listdir(directory), reverse=True):
+		if not filename.endswith(".json"): continue
+		raw = utils.read_file(f"{directory}/{filename}")
+		if raw == None: continue
+		capture = json.loads(raw)
+		capture["path"] = redact(capture["path"])
+		captures.append(capture)
+	return captures
+
+def report(options: dict[str, typing.Any], name: str, limit: int = 40) -> str | None:
+	# The functions of a capture with the most cumulative time, as text
+	filename = f"{options.get('directory', 'profiles')}/{name}.prof"
+	if "/" in name or not os.path.exists(filename): return None
+	out = io.StringIO()
+	pstats.Stats(filename, stream=out).sort_stats("cumulative").print_stats(limit)
+	return out.getvalue()
@@ -0,0 +1,61 @@
+import heapq
+import math
+import re
+import typing
+import pageindex
+import wiki
+
+WORD = re.compile(r"\w+")
+
+def tokenize(text: str) -> list[str]:
+	return WORD.findall(text.lower())
+
+class SearchResult(typing.NamedTuple):
+	page: str
+	score: float
+
+class SearchIndex(pageindex.PageIndex):
+	# Inverted index over the text fields of the newest revision of every page
+	def __init__(self, filename: str):
+		super().__init__(filename)
+		self.postings: "dict[str, dict[str, int]]" = {}
+		self.docs: "dict[str, list[str]]" = {}
+		self.lengths: "dict[str, int]" = {}
+		self.totalLength = 0
+	def extract(self, history: wiki.PageHistory) -> "dict[str, int]":
+		terms: dict[str, int] = {}
+		for field, value in history.mostRecent().data.items():
+			if history.ns.fields.get(field) == "file": continue
+			for term in tokenize(str(value, "UTF-8", "replace")):
+				terms[term] = terms.get(term, 0) + 1
+		return terms
+	def apply(self, page: str, value: "dict[str, int] | None"):
+		for term in self.docs.pop(page, []):
+			postings = self.postings[term]
+			del postings[page]
+			if len(postings) == 0: del self.postings[term]
+		self.totalLength -= self.lengths.pop(page, 0)
+		if value == None or len(value) == 0: return
+		self.docs[page] = [*value.keys()]
+		self.lengths[page] = sum(value.values())
+		self.totalLength += self.lengths[page]
+		for term, count in value.items():
+			self.postings.setdefault(term, {})[page] = count
+	def snapshotValue(self, page: str) -> "dict[str, int]":
+		return {term: self.postings[term][page] for term in self.docs.get(page, [])}
+	def query(self, text: str, offset: int = 0, limit: int = 20) -> "tuple[int, list[SearchResult]]":
+		# Ranks the pages containing every query term with BM25
+		self.load()
+		terms = [*set(tokenize(text))]
+		with self.lock:
+			if len(terms) == 0 or any([t not in self.postings for t in terms]): return (0, [])
+			lists = sorted([self.postings[t] for t in terms], key=len)
+			candidates = [page for page in lists[0] if all([page in p for p in lists[1:]])]
+			n = len(self.lengths)
+			averageLength = self.totalLength / n
+			idf = [math.log(1 + (n - len(p) + 0.5) / (len(p) + 0.5)) for p in lists]
+			def score(page: str) -> float:
+				norm = 1.2 * (0.25 + 0.75 * self.lengths[page] / averageLength)
+				return sum([idf[i] * lists[i][page] * 2.2 / (lists[i][page] + norm) for i in range(len(lists))])
+			scored = [SearchResult(page, score(page)) for page in candidates]
+		return (len(scored), heapq.nsmallest(offset + limit, scored, key=lambda r: (-r.score, r.page))[offset:])
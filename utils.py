@@ -1,4 +1,7 @@
 import typing
+import threading
+import mmap
+import os
 
 def read_file(filename: str) -> bytes | None:
 	try:
@@ -9,11 +12,51 @@ def read_file(filename: str) -> bytes | None:
 	except FileNotFoundError:
 		return
 
+def read_file_range(filename: str, start: int, end: int) -> bytes:
+	f = open(filename, "rb")
+	f.seek(start)
+	t = f.read(end - start)
+	f.close()
+	return t
+
+def map_file(filename: str) -> memoryview | None:
+	try:
+		f = open(filename, "rb")
+	except FileNotFoundError:
+		return
+	size = os.fstat(f.fileno()).st_size
+	if size == 0:
+		f.close()
+		return memoryview(b"")
+	m = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+	f.close()
+	return memoryview(m)
+
 def write_file(filename: str, content: bytes):
 	f = open(filename, "wb")
 	f.write(content)
 	f.close()
 
+def write_file_atomic(filename: str, content: bytes):
+	tmp = f"{filename}.{os.getpid()}.{threading.get_ident()}.tmp"
+	f = open(tmp, "wb")
+	f.write(content)
+	f.flush()
+	os.fsync(f.fileno())
+	f.close()
+	os.replace(tmp, filename)
+
+def append_file(filename: str, offset: int, content: bytes):
+	# Writes content at offset and cuts off anything after it, so a
+	# previously torn write can never end up in the middle of the file.
+	f = open(filename, "r+b")
+	f.seek(offset)
+	f.write(content)
+	f.truncate()
+	f.flush()
+	os.fsync(f.fileno())
+	f.close()
+
 T = typing.TypeVar('T')
 def optional(optional: T | None, default: T) -> T:
 	if optional == None: return default
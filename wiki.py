@@ -1,73 +1,216 @@
 import utils
+import blobs
+import diff
+import config
 import json
-import math
 import typing
+import collections.abc
 import base64
+import struct
+import zlib
+import os
+import time
+
+SEGMENT_TEXT = 0
+SEGMENT_FIELD = 1
+SEGMENT_FIELD64 = 2
+SEGMENT_PAGENS = 3
+SEGMENT_PAGENAME = 4
+
+class Template:
+	def __init__(self, segments: "list[tuple[int, bytes, str]]", tag: str = ""):
+		# Each segment is (kind, literal bytes or default value, field name)
+		self.segments = segments
+		# Identifies the template source, for building ETags
+		self.tag = tag
+	@staticmethod
+	def compile(data: bytes) -> "Template":
+		segments: "list[tuple[int, bytes, str]]" = []
+		textStart = 0
+		charno = data.find(b"{{")
+		while charno != -1:
+			directive: "tuple[int, bytes, str] | None" = None
+			end = charno
+			if data.startswith(b"{{field ", charno) or data.startswith(b"{{field64 ", charno):
+				kind = SEGMENT_FIELD if data.startswith(b"{{field ", charno) else SEGMENT_FIELD64
+				nameStart = charno + (len(b"{{field ") if kind == SEGMENT_FIELD else len(b"{{field64 "))
+				nameEnd = data.find(b" ", nameStart)
+				defaultEnd = data.find(b"}}", nameEnd + 1) if nameEnd != -1 else -1
+				if defaultEnd != -1:
+					directive = (kind, data[nameEnd + 1:defaultEnd], data[nameStart:nameEnd].decode("UTF-8"))
+					end = defaultEnd + 2
+			elif data.startswith(b"{{pagens}}", charno):
+				directive = (SEGMENT_PAGENS, b"", "")
+				end = charno + len(b"{{pagens}}")
+			elif data.startswith(b"{{pagename}}", charno):
+				directive = (SEGMENT_PAGENAME, b"", "")
+				end = charno + len(b"{{pagename}}")
+			if directive == None:
+				charno = data.find(b"{{", charno + 1)
+				continue
+			if textStart < charno:
+				segments.append((SEGMENT_TEXT, data[textStart:charno], ""))
+			segments.append(directive)
+			textStart = end
+			charno = data.find(b"{{", end)
+		if textStart < len(data):
+			segments.append((SEGMENT_TEXT, data[textStart:], ""))
+		return Template(segments, "%08x" % zlib.crc32(data))
+	def render(self, page: "Page") -> bytes:
+		r: "list[bytes | memoryview]" = []
+		for kind, value, name in self.segments:
+			if kind == SEGMENT_TEXT:
+				r.append(value)
+			elif kind == SEGMENT_FIELD or kind == SEGMENT_FIELD64:
+				fieldValue: "bytes | memoryview"
+				if name in page.data.keys():
+					fieldValue = page.data[name]
+				else:
+					fieldValue = value.replace(b"$pagename", page.name.encode("UTF-8"))
+				r.append(base64.b64encode(fieldValue) if kind == SEGMENT_FIELD64 else fieldValue)
+			elif kind == SEGMENT_PAGENS:
+				r.append(page.ns.name.encode("UTF-8"))
+			elif kind == SEGMENT_PAGENAME:
+				r.append(page.name.encode("UTF-8"))
+		return b"".join(r)
+
+# Compiled templates, keyed by namespace name; an entry is only reused while the
+# template source it was compiled from is unchanged.
+templateCache: "dict[str, tuple[str, Template]]" = {}
 
 def handlebars(data: bytes, page: "Page") -> bytes:
-	r: bytes = b""
-	charno = 0
-	while charno < len(data):
-		char = data[charno]
-		if data[charno:charno + len(b"{{field ")] == b"{{field ":
-			charno += len(b"{{field ")
-			name = ""
-			while bytes([data[charno]]) != b" ":
-				name += bytes([data[charno]]).decode("UTF-8")
-				charno += 1
-			charno += 1
-			defaultval = ""
-			while data[charno:charno + 2] != b"}}":
-				defaultval += bytes([data[charno]]).decode("UTF-8")
-				charno += 1
-			charno += 1
-			# Substitute the data
-			if name in page.data.keys():
-				r += page.data[name]
-			else:
-				r += defaultval.replace("$pagename", page.name).encode("UTF-8")
-		elif data[charno:charno + len(b"{{field64 ")] == b"{{field64 ":
-			charno += len(b"{{field64 ")
-			name = ""
-			while bytes([data[charno]]).decode("UTF-8") != " ":
-				name += bytes([data[charno]]).decode("UTF-8")
-				charno += 1
-			charno += 1
-			defaultval = ""
-			while data[charno:charno + 2] != b"}}":
-				defaultval += bytes([data[charno]]).decode("UTF-8")
-				charno += 1
-			charno += 1
-			# Substitute the data
-			if name in page.data.keys():
-				r += base64.b64encode(page.data[name])
-			else:
-				r += base64.b64encode(defaultval.replace("$pagename", page.name).encode("UTF-8"))
-		elif data[charno:charno + len(b"{{pagens}}")] == b"{{pagens}}":
-			charno += len(b"{{pagens}}") - 1
-			r += page.ns.name.encode("UTF-8")
-		elif data[charno:charno + len(b"{{pagename}}")] == b"{{pagename}}":
-			charno += len(b"{{pagename}}") - 1
-			r += page.name.encode("UTF-8")
-		else:
-			r += bytes([char])
-		charno += 1
-	return r
+	return Template.compile(data).render(page)
 
 class Buffer:
-	def __init__(self, data: bytes):
-		self.data = data
+	def __init__(self, data: "bytes | memoryview"):
+		# Reads hand out views into the underlying data instead of copies
+		self.data = memoryview(data)
 		self.pos = 0
-	def read(self, n: int) -> bytes:
+	def read(self, n: int) -> memoryview:
+		if self.pos + n > len(self.data): raise EOFError("Unexpected end of data")
 		result = self.data[self.pos:self.pos + n]
 		self.pos += n
 		return result
+	def skip(self, n: int):
+		if self.pos + n > len(self.data): raise EOFError("Unexpected end of data")
+		self.pos += n
 	def readInt(self) -> int:
+		if self.pos >= len(self.data): raise EOFError("Unexpected end of data")
 		result = self.data[self.pos]
 		self.pos += 1
 		return result
+	def readVarint(self) -> int:
+		result = 0
+		shift = 0
+		while True:
+			byte = self.readInt()
+			result |= (byte & 0x7F) << shift
+			if byte < 0x80: return result
+			shift += 7
 	def canRead(self) -> bool:
-		return self.pos < len(self.data) - 1
+		return self.pos < len(self.data)
+
+def writeVarint(out: bytearray, n: int):
+	while n >= 0x80:
+		out.append((n & 0x7F) | 0x80)
+		n >>= 7
+	out.append(n)
+
+# History files start with a magic string, the format version and a flags byte.
+# Files without the magic are version 1.
+HISTORY_MAGIC = b"WIKIHIST"
+HISTORY_VERSION = 2
+# Field values may be references into the blob store
+FLAG_BLOBS = 1
+# Entries may be stored as changes to the entry before them
+FLAG_DELTAS = 2
+KNOWN_FLAGS = FLAG_BLOBS | FLAG_DELTAS
+# In files with FLAG_DELTAS every entry's message is followed by its kind
+ENTRY_SNAPSHOT = 0
+ENTRY_DELTA = 1
+# How a delta entry stores each field of its page
+FIELD_SAME = 0
+FIELD_VALUE = 1
+FIELD_LINES = 2
+HISTORY_HEADER = HISTORY_MAGIC + bytes([HISTORY_VERSION, 0])
+# Flags for history files written from scratch, and the smallest field value
+# that goes to the blob store in files that use it
+historyFlags = FLAG_BLOBS
+blobMinBytes = 1024
+# Most delta entries in a row, so reading any entry decodes at most this many
+# entries after a snapshot
+maxDeltaChain = 16
+
+def configureStorage(settings: dict[str, typing.Any]):
+	# Large field values are stored once in pages/.blobs unless "blobs" is false.
+	# With "deltas", new histories store most revisions as line changes to the
+	# one before, with a full snapshot at least every "maxDeltaChain" revisions.
+	global historyFlags, blobMinBytes, maxDeltaChain
+	historyFlags = FLAG_BLOBS if settings.get("blobs", True) else 0
+	if settings.get("deltas", False): historyFlags |= FLAG_DELTAS
+	blobMinBytes = settings.get("blobMinBytes", 1024)
+	maxDeltaChain = settings.get("maxDeltaChain", 16)
+
+def writeValue(out: bytearray, value: "bytes | memoryview | blobs.Reference", flags: int):
+	if isinstance(value, blobs.Reference):
+		if flags & FLAG_BLOBS:
+			# Already stored, so it is referenced again without reading it
+			writeVarint(out, (len(value) << 1) | 1)
+			out += value.digest
+			return
+		value = value.read()
+	if flags & FLAG_BLOBS:
+		# The low bit of the length tells if a blob digest follows instead
+		if len(value) >= blobMinBytes:
+			writeVarint(out, (len(value) << 1) | 1)
+			out += blobs.write(value)
+			return
+		writeVarint(out, len(value) << 1)
+	else:
+		writeVarint(out, len(value))
+	out += value
+
+def readValue(b: Buffer, flags: int) -> "bytes | memoryview | blobs.Reference":
+	length = b.readVarint()
+	if flags & FLAG_BLOBS:
+		if length & 1: return blobs.Reference(bytes(b.read(blobs.DIGEST_BYTES)), length >> 1)
+		length >>= 1
+	# Left as a view, it is only copied if someone needs it
+	return b.read(length)
+
+def skipValue(b: Buffer, flags: int) -> bytes | None:
+	# Returns the blob digest if the value is a reference
+	length = b.readVarint()
+	if flags & FLAG_BLOBS:
+		if length & 1: return bytes(b.read(blobs.DIGEST_BYTES))
+		length >>= 1
+	b.skip(length)
+
+def splitLines(value: "bytes | memoryview") -> list[bytes]:
+	lines = bytes(value).split(b"\n")
+	last = lines.pop()
+	lines = [line + b"\n" for line in lines]
+	if last != b"": lines.append(last)
+	return lines
+
+def historyHeader(flags: int) -> bytes:
+	return HISTORY_MAGIC + bytes([HISTORY_VERSION, flags])
+
+def listNamespaces() -> list[str]:
+	# Entries starting with a dot hold bookkeeping files, not namespaces
+	return sorted([name for name in os.listdir("pages") if not name.startswith(".") and os.path.isdir(f"pages/{name}")])
+
+# Names of the namespace directories and when they were listed
+namespaceNames: "tuple[float, set[str]]" = (-config.checkInterval, set())
+
+def isNamespace(name: str) -> bool:
+	# Cheap enough to call for every link on a page
+	global namespaceNames
+	checked, names = namespaceNames
+	if time.monotonic() - checked >= config.checkInterval:
+		names = set(listNamespaces())
+		namespaceNames = (time.monotonic(), names)
+	return name in names
 
 class NSFileEntry(typing.TypedDict):
 	type: str
@@ -78,113 +221,485 @@ class Namespace:
 		self.fields = fields
 		self.defaultPage = defaultPage
 		self.content = content
+		self.template: Template | None = None
 	@staticmethod
 	def fromFile(name: str) -> "Namespace | None":
-		raw = utils.read_file(f"pages/{name}/ns.json")
-		if raw == None: return
+		watched = namespaceFiles.get(name)
+		if watched == None:
+			watched = config.WatchedFile(f"pages/{name}/ns.json", lambda raw: Namespace.fromJSON(name, raw))
+			# Only remember namespaces that exist, so bad names can't fill the registry
+			if watched.get() == None: return
+			watched = namespaceFiles.setdefault(name, watched)
+		return watched.get()
+	@staticmethod
+	def fromJSON(name: str, raw: bytes) -> "Namespace":
 		data = json.loads(raw)
 		return Namespace(name, data["fields"], data["defaultPage"], data["content"])
+	def getTemplate(self) -> Template:
+		if self.template == None:
+			cached = templateCache.get(self.name)
+			if cached == None or cached[0] != self.content:
+				cached = (self.content, Template.compile(self.content.encode("UTF-8")))
+				templateCache[self.name] = cached
+			self.template = cached[1]
+		return self.template
 	def getContent(self, page: "Page"):
-		return handlebars(self.content.encode("UTF-8"), page)
+		return self.getTemplate().render(page)
+
+# Parsed ns.json files, reloaded when they change on disk
+namespaceFiles: "dict[str, config.WatchedFile[Namespace]]" = {}
+
+class EntryOffsets:
+	# Start offset of every saved entry. The first `indexed` of them are only in
+	# the .idx file and are read from it when they are needed; the file stays
+	# open so a later rewrite of the page can't change what they say.
+	def __init__(self, index: "typing.BinaryIO | None" = None, indexed: int = 0):
+		self.index = index
+		self.indexed = indexed
+		self.read: "dict[int, int]" = {}
+		self.tail: list[int] = []
+	def __len__(self) -> int:
+		return self.indexed + len(self.tail)
+	def __getitem__(self, n: int) -> int:
+		if n < 0: n += len(self)
+		if n >= self.indexed: return self.tail[n - self.indexed]
+		if n not in self.read:
+			self.read[n] = self.slice(n, n + 1)[0]
+		return self.read[n]
+	def slice(self, start: int, end: int) -> list[int]:
+		# Offsets start to end with a single read of the index
+		end = min(end, len(self))
+		indexedEnd = max(start, min(end, self.indexed))
+		r: list[int] = []
+		if start < indexedEnd:
+			assert self.index != None
+			raw = os.pread(self.index.fileno(), (indexedEnd - start) * 8, start * 8)
+			r = [*struct.unpack(f">{indexedEnd - start}Q", raw)]
+		return r + self.tail[max(start, self.indexed) - self.indexed:end - self.indexed]
+	def extend(self, offsets: list[int]):
+		self.tail.extend(offsets)
 
 class PageHistory:
 	def __init__(self, ns: Namespace, name: str, data: "list[tuple[str, Page]]"):
 		self.ns = ns
 		self.name = name
-		self.data: "list[tuple[str, Page]]" = data
-	def toBytes(self) -> bytes:
-		r: list[int] = []
-		for i in self.data:
-			# Write message length
-			r.append(len(i[0]))
-			# Write message
-			r.extend([*i[0].encode("UTF-8")])
-			# Write page
-			r.extend(i[1].toInts())
+		# Format of the file on disk; version 1 files have no header
+		self.version = HISTORY_VERSION
+		self.flags = historyFlags
+		# Delta entries at the end of the file, if known
+		self.chain: int | None = None
+		# Start offset of every entry that is already on disk, and where the last one ends
+		self.offsets = EntryOffsets()
+		self.savedBytes = 0
+		# Entries that have not been saved yet
+		self.pending: "list[tuple[str, Page]]" = data
+		self.decoded: "dict[int, tuple[str, Page]]" = {}
+		# Read-only mapping of the data file, shared by every decoded entry
+		self.view: memoryview = memoryview(b"")
+	def __len__(self) -> int:
+		return len(self.offsets) + len(self.pending)
+	@property
+	def data(self) -> "list[tuple[str, Page]]":
+		return [self.getEntry(i) for i in range(len(self))]
+	def getFilename(self) -> str:
+		return f"pages/{self.ns.name}/{self.name}.dat"
+	def getIndexFilename(self) -> str:
+		return f"pages/{self.ns.name}/{self.name}.idx"
+	def getEntry(self, n: int) -> "tuple[str, Page]":
+		if n < 0: n += len(self)
+		if n >= len(self.offsets):
+			return self.pending[n - len(self.offsets)]
+		if n not in self.decoded:
+			start, end = (self.offsets.slice(n, n + 2) + [self.savedBytes])[:2]
+			raw = Buffer(self.view[start:end])
+			if self.flags & FLAG_DELTAS:
+				self.decoded[n] = self.readDeltaEntry(n, raw)
+			else:
+				self.decoded[n] = PageHistory.readOneEntry(self.ns, self.name, raw, self.version, self.flags)
+		return self.decoded[n]
+	def readDeltaEntry(self, n: int, b: Buffer) -> "tuple[str, Page]":
+		# Skip the entry length and checksum
+		b.readVarint()
+		b.skip(4)
+		message = str(b.read(b.readVarint()), "UTF-8")
+		if b.readInt() == ENTRY_SNAPSHOT:
+			return (message, Page.read(self.ns, self.name, b, self.version, self.flags))
+		return (message, Page.readDelta(self.ns, self.name, b, self.flags, self.getEntry(n - 1)[1]))
+	def entryKind(self, n: int) -> int:
+		b = Buffer(self.view[self.offsets[n]:])
+		b.readVarint()
+		b.skip(4)
+		b.skip(b.readVarint())
+		return b.readInt()
+	def deltaChain(self) -> int:
+		# How many delta entries the saved entries end with
+		if self.chain == None:
+			self.chain = 0
+			while self.chain < len(self.offsets) and self.entryKind(len(self.offsets) - 1 - self.chain) == ENTRY_DELTA:
+				self.chain += 1
+		return self.chain
+	@staticmethod
+	def entryToBytes(message: str, page: "Page", flags: int = 0, previous: "Page | None" = None) -> bytes:
+		payload = bytearray()
+		encodedMessage = message.encode("UTF-8")
+		# Write message
+		writeVarint(payload, len(encodedMessage))
+		payload += encodedMessage
+		# Write page
+		if flags & FLAG_DELTAS:
+			payload.append(ENTRY_SNAPSHOT if previous == None else ENTRY_DELTA)
+		if previous != None:
+			page.writeDelta(payload, flags, previous)
+		else:
+			page.write(payload, flags)
+		# Frame the entry with its length and checksum
+		r = bytearray()
+		writeVarint(r, len(payload))
+		r += struct.pack(">I", zlib.crc32(payload))
+		r += payload
 		return bytes(r)
+	def rewrite(self, flags: int | None = None):
+		# Write out the whole history again in the current format
+		self.pending = self.data
+		self.offsets = EntryOffsets()
+		self.decoded = {}
+		self.flags = historyFlags if flags == None else flags
+		self.save()
 	def save(self):
-		data = self.toBytes()
-		filename = f"pages/{self.ns.name}/{self.name}.dat"
-		utils.write_file(filename, data)
+		if self.version != HISTORY_VERSION and len(self.offsets) > 0:
+			# Older files are upgraded the first time they are written to
+			self.rewrite()
+			return
+		filename = self.getFilename()
+		newOffsets: list[int] = []
+		data: list[bytes] = []
+		pos = self.savedBytes if len(self.offsets) > 0 else len(HISTORY_HEADER)
+		chain = self.deltaChain() if self.flags & FLAG_DELTAS else 0
+		for i, entry in enumerate(self.pending):
+			newOffsets.append(pos)
+			previous = None
+			n = len(self.offsets) + i
+			if self.flags & FLAG_DELTAS and n > 0 and chain < maxDeltaChain:
+				previous = self.getEntry(n - 1)[1]
+			data.append(PageHistory.entryToBytes(*entry, self.flags, previous))
+			chain = 0 if previous == None else chain + 1
+			pos += len(data[-1])
+		if len(self.offsets) == 0:
+			# The index must never describe a different file than the one on disk
+			if os.path.exists(self.getIndexFilename()): os.remove(self.getIndexFilename())
+			utils.write_file_atomic(filename, historyHeader(self.flags) + b"".join(data))
+			self.version = HISTORY_VERSION
+		else:
+			# Only the new entries need to be written
+			utils.append_file(filename, self.savedBytes, b"".join(data))
+		for i in range(len(self.pending)):
+			self.decoded[len(self.offsets) + i] = self.pending[i]
+		start = len(self.offsets)
+		self.offsets.extend(newOffsets)
+		self.savedBytes = pos
+		self.pending = []
+		self.chain = chain
+		PageHistory.writeIndex(self.getIndexFilename(), start, newOffsets)
+	@staticmethod
+	def writeIndex(filename: str, start: int, offsets: list[int]):
+		# Writes the offsets of entries start and up
+		if start == 0:
+			utils.write_file_atomic(filename, struct.pack(f">{len(offsets)}Q", *offsets))
+			return
+		utils.append_file(filename, start * 8, struct.pack(f">{len(offsets)}Q", *offsets))
 	@staticmethod
 	def fromFile(name: str) -> "PageHistory | None":
 		ns = name.split(":")[0]
 		pn = name.split(":")[1]
 		nso = Namespace.fromFile(ns)
 		if nso == None: return
-		raw_data = utils.read_file(f"pages/{ns}/{pn}.dat")
-		if raw_data == None: return PageHistory(nso, pn, [])
-		raw = Buffer(raw_data)
-		out: list[tuple[str, Page]] = []
+		history = PageHistory(nso, pn, [])
+		filename = history.getFilename()
+		view = utils.map_file(filename)
+		if view == None: return history
+		history.view = view
+		size = len(view)
+		dataStart = 0
+		history.version = 1
+		history.flags = 0
+		if view[:len(HISTORY_MAGIC)] == HISTORY_MAGIC:
+			history.version = view[len(HISTORY_MAGIC)]
+			if history.version > HISTORY_VERSION:
+				raise ValueError(f"{filename} uses unsupported history format version {history.version}")
+			history.flags = view[len(HISTORY_MAGIC) + 1]
+			if history.flags & ~KNOWN_FLAGS:
+				raise ValueError(f"{filename} uses unsupported history flags {history.flags}")
+			dataStart = len(HISTORY_HEADER)
+		# Trust the index up to its last entry, then scan whatever follows it;
+		# only that entry is read now, the others when they are asked for
+		try:
+			index = open(history.getIndexFilename(), "rb")
+		except FileNotFoundError:
+			index = None
+		indexed = 0 if index == None else os.fstat(index.fileno()).st_size // 8
+		offsets = EntryOffsets()
+		scanStart = dataStart
+		if index != None and indexed > 0:
+			last = struct.unpack(">Q", os.pread(index.fileno(), 8, (indexed - 1) * 8))[0]
+			if dataStart <= last < size:
+				offsets = EntryOffsets(index, indexed - 1)
+				scanStart = last
+		scanned, end, status = PageHistory.scan(view, scanStart, history.version)
+		if (status == "damaged" or len(scanned) == 0) and scanStart != dataStart:
+			# The index might be wrong rather than the file; a torn tail is only
+			# believed after the indexed entry itself checked out
+			offsets = EntryOffsets()
+			scanStart = dataStart
+			scanned, end, status = PageHistory.scan(view, scanStart, history.version)
+		if status == "damaged":
+			# Something other than an interrupted write; leave the file for a person to look at
+			raise ValueError(f"{filename} is damaged at offset {end}")
+		# A torn last entry is left for the next save to overwrite; other readers
+		# may have the file mapped, so it is never cut off here
+		offsets.extend(scanned)
+		history.offsets = offsets
+		history.savedBytes = end
+		if len(offsets) != indexed or scanStart == dataStart and indexed > 0:
+			# Replaced as a whole, since other readers may be reading it
+			PageHistory.writeIndex(history.getIndexFilename(), 0, offsets.slice(0, len(offsets)))
+		return history
+	@staticmethod
+	def scan(view: memoryview, start: int, version: int) -> "tuple[list[int], int, str]":
+		# Find where each entry starts, stopping at the first damaged one. The
+		# status is "complete", "torn" if only the last entry runs past the end
+		# of the file, or "damaged".
+		raw = Buffer(view)
+		raw.pos = start
+		starts: list[int] = []
 		while raw.canRead():
-			out.append(PageHistory.readOneEntry(nso, pn, raw))
-		return PageHistory(nso, pn, out)
+			entryStart = raw.pos
+			try:
+				PageHistory.skipEntry(raw, version)
+			except EOFError:
+				# Version 1 files are never appended to, so they can't be torn
+				return (starts, entryStart, "torn" if version != 1 else "damaged")
+			except ValueError:
+				return (starts, entryStart, "damaged")
+			starts.append(entryStart)
+		return (starts, raw.pos, "complete")
 	@staticmethod
-	def readOneEntry(ns: Namespace, name: str, b: Buffer) -> "tuple[str, Page]":
-		# Read length of message
-		ml = b.readInt()
+	def skipEntry(b: Buffer, version: int):
+		if version == 1:
+			# Read length of message and skip it
+			b.skip(b.readInt())
+			# Skip every field
+			for _ in range(b.readInt()):
+				b.skip(b.readInt())
+				b.skip((((b.readInt() * 256) + b.readInt()) * 256) + b.readInt())
+			return
+		length = b.readVarint()
+		checksum = struct.unpack(">I", b.read(4))[0]
+		if zlib.crc32(b.read(length)) != checksum:
+			raise ValueError("Entry checksum does not match")
+	@staticmethod
+	def readOneEntry(ns: Namespace, name: str, b: Buffer, version: int = HISTORY_VERSION, flags: int = 0) -> "tuple[str, Page]":
+		if version == 1:
+			# Read length of message
+			ml = b.readInt()
+		else:
+			# Skip the entry length and checksum
+			b.readVarint()
+			b.skip(4)
+			ml = b.readVarint()
 		# Read message
-		message = b.read(ml).decode("UTF-8")
+		message = str(b.read(ml), "UTF-8")
 		# print("read message length", ml, "data:", message)
 		# Read page
-		page = Page.read(ns, name, b)
+		page = Page.read(ns, name, b, version, flags)
 		# Return
 		return (message, page)
+	def blobReferences(self, start: int = 0) -> "dict[bytes, int]":
+		# How often each blob is referenced by the saved entries from start on,
+		# found without opening any of the blobs
+		references: "dict[bytes, int]" = {}
+		if not self.flags & FLAG_BLOBS: return references
+		view = self.view
+		if len(view) < self.savedBytes:
+			# Entries saved through this object are not in the old mapping
+			view = utils.optional(utils.map_file(self.getFilename()), view)
+		offsets = self.offsets.slice(start, len(self.offsets)) + [self.savedBytes]
+		for n in range(len(offsets) - 1):
+			b = Buffer(view[offsets[n]:offsets[n + 1]])
+			# Skip the entry length, checksum and message
+			b.readVarint()
+			b.skip(4)
+			b.skip(b.readVarint())
+			delta = self.flags & FLAG_DELTAS and b.readInt() == ENTRY_DELTA
+			for _ in range(b.readVarint()):
+				b.skip(b.readVarint())
+				if delta:
+					kind = b.readInt()
+					if kind == FIELD_LINES:
+						for _ in range(b.readVarint()):
+							op = b.readVarint()
+							if op & 1:
+								b.skip(op >> 1)
+							else:
+								b.readVarint()
+						continue
+					if kind != FIELD_VALUE: continue
+				digest = skipValue(b, self.flags)
+				if digest != None: references[digest] = references.get(digest, 0) + 1
+		return references
 	def mostRecent(self):
-		if len(self.data) == 0:
+		if len(self) == 0:
 			return Page(self.ns, self.name, {})
-		return self.data[-1][1]
-	def append(self, message: str, data: dict[str, bytes]):
-		self.data.append((message, Page(self.ns, self.name, data)))
-	def appendEdit(self, message: str, editName: str, editValue: bytes):
+		return self.getEntry(-1)[1]
+	def append(self, message: str, data: "dict[str, bytes | memoryview | blobs.Reference]"):
+		self.pending.append((message, Page(self.ns, self.name, data)))
+	def appendEdit(self, message: str, editName: str, editValue: "bytes | memoryview"):
 		oldPage = self.mostRecent()
 		newData = oldPage.data.copy()
 		newData[editName] = editValue
 		self.append(message, newData)
 	def appendDelete(self, message: str):
 		self.append(message, {})
+	def exists(self) -> bool:
+		# Creating a page starts a history with one empty revision, and deleting
+		# one appends another, so only a later empty revision means deleted
+		if len(self) == 0: return False
+		return len(self) == 1 or len(self.mostRecent().data) > 0
+
+class FieldValues(collections.abc.Mapping[str, "bytes | memoryview"]):
+	# A page's fields, reading each blob reference the first time its value is used
+	def __init__(self, fields: "dict[str, bytes | memoryview | blobs.Reference]"):
+		self.fields = fields
+	def __getitem__(self, name: str) -> "bytes | memoryview":
+		value = self.fields[name]
+		return value.read() if isinstance(value, blobs.Reference) else value
+	def __iter__(self) -> typing.Iterator[str]:
+		return iter(self.fields)
+	def __len__(self) -> int:
+		return len(self.fields)
+	def copy(self) -> "dict[str, bytes | memoryview | blobs.Reference]":
+		# References stay unread
+		return self.fields.copy()
 
 class Page:
-	def __init__(self, ns: Namespace, name: str, data: dict[str, bytes]):
+	def __init__(self, ns: Namespace, name: str, data: "dict[str, bytes | memoryview | blobs.Reference]"):
 		self.ns = ns
 		self.name = name
-		self.data = data
+		# Values as stored, which may be blob references; len() works on all of them
+		self.fields = data
+		self.data = FieldValues(data)
 	def getContent(self):
 		return self.ns.getContent(self)
-	def toInts(self) -> list[int]:
-		names = [*self.data.keys()]
-		r: list[int] = [len(names)]
-		for name in names:
-			# Write name length
-			r.append(len(name))
+	def write(self, out: bytearray, flags: int = 0):
+		# Write # of entries
+		writeVarint(out, len(self.fields))
+		for name, value in self.fields.items():
 			# Write name
-			r.extend([*name.encode("UTF-8")])
-			# Write value length
-			value = self.data[name]
-			r.append(math.floor(len(value) / (256 * 256)) % 256)
-			r.append(math.floor(len(value) / 256) % 256)
-			r.append(len(value) % 256)
+			encodedName = name.encode("UTF-8")
+			writeVarint(out, len(encodedName))
+			out += encodedName
 			# Write value
-			r.extend([*value])
-		return r
+			writeValue(out, value, flags)
+	def writeDelta(self, out: bytearray, flags: int, previous: "Page"):
+		# Like write, but each field says how it differs from the previous page
+		writeVarint(out, len(self.fields))
+		for name, value in self.fields.items():
+			encodedName = name.encode("UTF-8")
+			writeVarint(out, len(encodedName))
+			out += encodedName
+			old = previous.fields.get(name)
+			if old != None and old == value:
+				out.append(FIELD_SAME)
+				continue
+			if old != None:
+				# Tried first so a small change to a large value isn't written to
+				# the blob store at all
+				lines = bytearray([FIELD_LINES])
+				Page.writeLineDelta(lines, splitLines(old), splitLines(value))
+				if len(lines) < len(value):
+					out += lines
+					continue
+			out.append(FIELD_VALUE)
+			writeValue(out, value, flags)
+	@staticmethod
+	def writeLineDelta(out: bytearray, old: list[bytes], new: list[bytes]):
+		# Operations that build new from old: copy a run of old lines, or insert
+		# bytes. A copy is written as varint (count << 1) and varint start, an
+		# insert as varint (length << 1 | 1) and the bytes.
+		ops: "list[tuple[int, int] | bytes]" = []
+		i = 0
+		for op, line in diff.diffLines([l.decode("latin-1") for l in old], [l.decode("latin-1") for l in new]):
+			if op == diff.EQUAL:
+				last = ops[-1] if len(ops) > 0 else None
+				if isinstance(last, tuple) and last[0] + last[1] == i:
+					ops[-1] = (last[0], last[1] + 1)
+				else:
+					ops.append((i, 1))
+				i += 1
+			elif op == diff.DELETE:
+				i += 1
+			else:
+				if len(ops) > 0 and isinstance(ops[-1], bytes):
+					ops[-1] += line.encode("latin-1")
+				else:
+					ops.append(line.encode("latin-1"))
+		writeVarint(out, len(ops))
+		for op in ops:
+			if isinstance(op, bytes):
+				writeVarint(out, (len(op) << 1) | 1)
+				out += op
+			else:
+				writeVarint(out, op[1] << 1)
+				writeVarint(out, op[0])
+	def toBytes(self) -> bytes:
+		r = bytearray()
+		self.write(r)
+		return bytes(r)
 	@staticmethod
-	def read(ns: Namespace, pagename: str, b: Buffer):
-		entries: dict[str, bytes] = {}
+	def read(ns: Namespace, pagename: str, b: Buffer, version: int = HISTORY_VERSION, flags: int = 0):
+		entries: "dict[str, bytes | memoryview | blobs.Reference]" = {}
+		readLength = b.readInt if version == 1 else b.readVarint
 		# Read # of entries
-		n_entries = b.readInt()
+		n_entries = readLength()
 		# For each entry
 		for _ in range(n_entries):
 			# Read name length
-			namel = b.readInt()
+			namel = readLength()
 			# Read name
-			name = b.read(namel).decode("UTF-8")
+			name = str(b.read(namel), "UTF-8")
+			if version != 1:
+				entries[name] = readValue(b, flags)
+				continue
 			# Read value length
 			vall = (((b.readInt() * 256) + b.readInt()) * 256) + b.readInt()
-			# Read value
+			# Read value (left as a view, it is only copied if someone needs it)
 			val = b.read(vall)
 			# Finish
 			entries[name] = val
 		return Page(ns, pagename, entries)
+	@staticmethod
+	def readDelta(ns: Namespace, pagename: str, b: Buffer, flags: int, previous: "Page"):
+		entries: "dict[str, bytes | memoryview | blobs.Reference]" = {}
+		for _ in range(b.readVarint()):
+			name = str(b.read(b.readVarint()), "UTF-8")
+			kind = b.readInt()
+			if kind == FIELD_SAME:
+				entries[name] = previous.fields[name]
+			elif kind == FIELD_VALUE:
+				entries[name] = readValue(b, flags)
+			elif kind == FIELD_LINES:
+				old = splitLines(previous.data[name])
+				parts: list[bytes | memoryview] = []
+				for _ in range(b.readVarint()):
+					op = b.readVarint()
+					if op & 1:
+						parts.append(b.read(op >> 1))
+					else:
+						start = b.readVarint()
+						parts.extend(old[start:start + (op >> 1)])
+				entries[name] = b"".join(parts)
+			else:
+				raise ValueError(f"Unknown field kind {kind}")
+		return Page(ns, pagename, entries)
 
 if __name__ == "__main__":
 	ns = Namespace.fromFile("Main")
@@ -1,76 +1,79 @@
+import re
+import typing
+
+# Markup tokens recognized inside a line; in raw regions only the region markers matter.
+TOKENS = re.compile(r"\$END|\$START|\*|_|\[\[")
+RAW_TOKENS = re.compile(r"\$END|\$START")
+
 class TextSpan:
 	def __init__(self, t: str):
 		self.t = t
-	def toHTML(self):
+	def toHTML(self, linkExists: "typing.Callable[[str], bool] | None" = None):
 		return self.t
 	@staticmethod
 	def read(line: str, raw: bool) -> "tuple[list[TextSpan], bool]":
 		spans: "list[TextSpan]" = []
 		currentType: "type[TextSpan]" = TextSpan
 		if raw: currentType = TextSpanRaw
-		current = ""
+		current: list[str] = []
 		i = 0
-		while i < len(line):
-			if line[i:i + len("$END")] == "$END":
-				spans.append(currentType(current))
-				current = ""
-				i += len("$END") - 1
+		while True:
+			match = (RAW_TOKENS if currentType == TextSpanRaw else TOKENS).search(line, i)
+			if match == None: break
+			token = match.group()
+			current.append(line[i:match.start()])
+			i = match.end()
+			if token == "[[":
+				end = line.find("]]", i)
+				if end == -1:
+					# Unterminated link, keep it as text
+					current.append(token)
+					continue
+				spans.append(currentType("".join(current)))
+				current = []
+				# Add the span
+				idata = line[i:end]
+				spans.append(TextSpanLink(idata, "/wiki/" + idata))
+				i = end + 2
+				continue
+			spans.append(currentType("".join(current)))
+			current = []
+			if token == "$END":
 				currentType = TextSpanRaw
-			elif line[i:i + len("$START")] == "$START":
-				spans.append(currentType(current))
-				current = ""
-				i += len("$START") - 1
+			elif token == "$START":
 				currentType = TextSpan
-			elif currentType == TextSpanRaw:
-				current += line[i]
-			elif line[i] == "*":
-				spans.append(currentType(current))
-				current = ""
+			elif token == "*":
 				if currentType == TextSpanBold:
 					currentType = TextSpan
 				else:
 					currentType = TextSpanBold
-			elif line[i] == "_":
-				spans.append(currentType(current))
-				current = ""
+			elif token == "_":
 				if currentType == TextSpanItalic:
 					currentType = TextSpan
 				else:
 					currentType = TextSpanItalic
-			elif line[i:i + 2] == "[[":
-				spans.append(currentType(current))
-				current = ""
-				# Get the link data
-				idata = ""
-				i += 2
-				while line[i:i + 2] != "]]":
-					idata += line[i]
-					i += 1
-				i += 1
-				# Add the span
-				spans.append(TextSpanLink(idata, "/wiki/" + idata))
-			else:
-				current += line[i]
-			i += 1
-		spans.append(currentType(current))
+		current.append(line[i:])
+		spans.append(currentType("".join(current)))
 		return (spans, currentType == TextSpanRaw)
 
 class TextSpanRaw(TextSpan):
 	pass
 
 class TextSpanBold(TextSpan):
-	def toHTML(self):
+	def toHTML(self, linkExists: "typing.Callable[[str], bool] | None" = None):
 		return f"<b>{self.t}</b>"
 
 class TextSpanItalic(TextSpan):
-	def toHTML(self):
+	def toHTML(self, linkExists: "typing.Callable[[str], bool] | None" = None):
 		return f"<i>{self.t}</i>"
 
 class TextSpanLink(TextSpan):
 	def __init__(self, t: str, href: str):
 		super().__init__(t)
 		self.href = href
-	def toHTML(self):
+	def toHTML(self, linkExists: "typing.Callable[[str], bool] | None" = None):
+		if linkExists != None and not linkExists(self.t):
+			return f"<a href=\"{self.href}\" class=\"new\">{self.t}</a>"
 		return f"<a href=\"{self.href}\">{self.t}</a>"
 
 class Paragraph:
@@ -80,12 +83,8 @@ class Paragraph:
 		return "<p>"
 	def getSuffix(self) -> str:
 		return "</p>"
-	def toHTML(self):
-		r: str = self.getPrefix()
-		for s in self.spans:
-			r += s.toHTML()
-		r += self.getSuffix()
-		return r
+	def toHTML(self, linkExists: "typing.Callable[[str], bool] | None" = None):
+		return self.getPrefix() + "".join([s.toHTML(linkExists) for s in self.spans]) + self.getSuffix()
 
 class Heading1(Paragraph):
 	def getPrefix(self):
@@ -109,9 +108,13 @@ def parse(inputStr: str) -> list[Paragraph]:
 			paras.append(Paragraph(info[0]))
 	return paras
 
-def wtToHTML(inputStr: str) -> str:
+def findLinks(inputStr: str) -> list[str]:
+	return [s.t for p in parse(inputStr) for s in p.spans if isinstance(s, TextSpanLink)]
+
+def wtToHTML(inputStr: str, linkExists: "typing.Callable[[str], bool] | None" = None) -> str:
+	# linkExists is given each link target; links to missing pages are marked "new"
 	paras = parse(inputStr)
-	r = [x.toHTML() for x in paras]
+	r = [x.toHTML(linkExists) for x in paras]
 	return "".join(r)
 
 if __name__ == "__main__":